@@ -11,15 +11,21 @@ http://arxiv.org/abs/1505.02937
 """
 
 import logging
+import multiprocessing
 import numpy as np
+import healpy as hp
 
 import os
 import re
+import csv
+import hashlib
+import itertools
 from astropy.coordinates import Angle, SkyCoord
 import astropy.units as u
 from astropy.io import fits as pyfits
 from astropy.wcs import wcs as pywcs
-from regions import Region
+from regions import Region, merge_ranges
+from angle_tools import gcd
 from catalogs import load_table, write_table
 
 __version__ = 'v1.2.5'
@@ -31,8 +37,17 @@ try:
 except ImportError:
     import pickle
 
+try:
+    import h5py
+    hdf5_supported = True
+except ImportError:
+    hdf5_supported = False
+
 # globals
 filewcs = None
+# the version of the region_mask algorithm, which is part of the key for cached masks
+# so that masks made by an earlier version are not reused
+region_mask_version = 2
 
 
 class Dummy():
@@ -45,6 +60,7 @@ class Dummy():
         self.exclude_polygons = []
         self.maxdepth = maxdepth
         self.galactic = False
+        self.cores = 1
         return
 
 
@@ -68,30 +84,176 @@ def mask_plane(data, wcs, region, negate=False):
     :param negate: If True then pixels *outside* the region are set to nan.
     :return: the masked data (which is modified in place anyway)
     """
-    # create an array but don't set the values (they are random)
-    indexes = np.empty((data.shape[0]*data.shape[1], 2), dtype=int)
-    # since I know exactly what the index array needs to look like i can construct
-    # it faster than list comprehension would allow
-    # we do this only once and then recycle it
-    idx = np.array([(j, 0) for j in xrange(data.shape[1])])
-    j = data.shape[1]
-    for i in xrange(data.shape[0]):
-        idx[:, 1] = i
-        indexes[i*j:(i+1)*j] = idx
-
-    # put ALL the pixles into our vectorized functions and minimise our overheads
-    ra, dec = wcs.wcs_pix2world(indexes, 1).transpose()
-    bigmask = region.sky_within(ra, dec, degin=True)
+    mask = region_mask(data.shape, wcs, region)
     if not negate:
-        bigmask = np.bitwise_not(bigmask)
-    # rework our 1d list into a 2d array
-    bigmask = bigmask.reshape(data.shape)
-    # and apply the mask
-    data[bigmask] = np.nan
+        mask = np.bitwise_not(mask)
+    data[mask] = np.nan
     return data
 
 
-def mask_file(regionfile, infile, outfile, negate=False):
+def _pixel_scales(shape, wcs, npoints=32):
+    """
+    Measure the angular size of the pixels on a grid of npoints x npoints positions that covers an image.
+    The size is the length of the pixel diagonal, which is at least the largest extent of the pixel on the sky.
+    :param shape: the shape of the image
+    :param wcs: a WCS object
+    :param npoints: the number of positions along each axis
+    :return: an array of pixel sizes in degrees, excluding positions that are not within the projection
+    """
+    rows, cols = [a.ravel() for a in np.meshgrid(np.linspace(0, shape[0] - 1, npoints),
+                                                 np.linspace(0, shape[1] - 1, npoints), indexing='ij')]
+    ra, dec = wcs.wcs_pix2world(np.column_stack([np.concatenate([cols, cols, cols + 1]),
+                                                 np.concatenate([rows, rows + 1, rows])]), 1).transpose()
+    ra, dec = ra.reshape(3, -1), dec.reshape(3, -1)
+    with np.errstate(invalid='ignore'):
+        sizes = np.hypot(gcd(ra[0], dec[0], ra[1], dec[1]), gcd(ra[0], dec[0], ra[2], dec[2]))
+    return sizes[np.isfinite(sizes)]
+
+
+def region_mask(shape, wcs, region, step=None):
+    """
+    Rasterise a region onto an image grid, using the same pixel convention as mask_plane.
+    The region is first evaluated on a grid of nodes every step pixels, which extends beyond the edges of
+    the image by the size of a region pixel. Every pixel is then evaluated within the cells of this grid
+    (and their neighbours) that have corners both within and outside of the region, corners both on and
+    off the projection, or that are more than half the size of a region pixel on the sky.
+    This matches evaluating every pixel as long as no part of the region (or gap within it) is narrower
+    than a cell, which the limit on the cell size ensures for the pixels of the region.
+    :param shape: the shape of the image
+    :param wcs: a WCS object
+    :param region: a MIMAS region
+    :param step: the grid spacing in pixels. Default = chosen so that a typical cell is less than half the size
+                 of a pixel in region.
+    :return: a boolean array of the given shape that is True for pixels within the region
+    """
+    nx, ny = shape
+    # the side length of a healpix pixel at maxdepth (deg)
+    hp_size = np.degrees(np.sqrt(np.pi / 3) / 2 ** region.maxdepth)
+    scales = _pixel_scales(shape, wcs)
+    if len(scales) == 0:
+        scales = np.array([np.sqrt(2 * abs(np.linalg.det(wcs.pixel_scale_matrix)))])
+    if step is None:
+        step = int(min(max(0.4 * hp_size / np.median(scales), 1), 32))
+
+    def within(rows, cols):
+        """
+        Determine which of the pixels (rows[i], cols[i]) are within the region
+        """
+        inside = np.zeros(len(rows), dtype=bool)
+        # work in blocks to limit the size of the temporary arrays
+        for i in xrange(0, len(rows), region.chunksize):
+            sl = slice(i, i + region.chunksize)
+            ra, dec = wcs.wcs_pix2world(np.column_stack([cols[sl], rows[sl]]), 1).transpose()
+            good = np.isfinite(ra) & np.isfinite(dec)
+            if np.any(good):
+                inside[sl][good] = region.sky_within(ra[good], dec[good], degin=True)
+        return inside
+
+    if step <= 1:
+        mask = np.empty(shape, dtype=bool)
+        nrows = max(region.chunksize // max(ny, 1), 1)
+        for i in xrange(0, nx, nrows):
+            rows, cols = np.indices((min(nrows, nx - i), ny))
+            mask[i:i + nrows] = within(rows.ravel() + i, cols.ravel()).reshape(rows.shape)
+        return mask
+
+    # grid nodes, including nodes outside the image so that parts of the region that
+    # only clip the edge of the image are found in the same way as those within the image
+    pad = step * (int(np.ceil(hp_size / scales.min() / step)) + 1)
+    xnodes = np.arange(-pad, nx + pad, step)
+    ynodes = np.arange(-pad, ny + pad, step)
+    rows, cols = np.meshgrid(xnodes, ynodes, indexing='ij')
+    ra, dec = wcs.wcs_pix2world(np.column_stack([cols.ravel(), rows.ravel()]), 1).transpose()
+    ra, dec = ra.reshape(rows.shape), dec.reshape(rows.shape)
+    valid = np.isfinite(ra) & np.isfinite(dec)
+    inside = np.zeros(rows.shape, dtype=bool)
+    inside[valid] = region.sky_within(ra[valid], dec[valid], degin=True)
+
+    # cells are between adjacent nodes
+    refine = np.zeros((len(xnodes) - 1, len(ynodes) - 1), dtype=bool)
+    for nodes in [inside, valid]:
+        corners = [nodes[:-1, :-1], nodes[1:, :-1], nodes[:-1, 1:], nodes[1:, 1:]]
+        refine |= np.logical_or.reduce(corners) & ~np.logical_and.reduce(corners)
+    # cells that are too large on the sky, as measured by their diagonals
+    with np.errstate(invalid='ignore'):
+        size = np.fmax(gcd(ra[:-1, :-1], dec[:-1, :-1], ra[1:, 1:], dec[1:, 1:]),
+                       gcd(ra[1:, :-1], dec[1:, :-1], ra[:-1, 1:], dec[:-1, 1:]))
+        refine |= size > 0.5 * hp_size
+    allin = np.logical_and.reduce([inside[:-1, :-1], inside[1:, :-1], inside[:-1, 1:], inside[1:, 1:]])
+    # also refine the neighbouring cells
+    grown = refine.copy()
+    grown[1:, :] |= refine[:-1, :]
+    grown[:-1, :] |= refine[1:, :]
+    grown[:, 1:] |= grown[:, :-1].copy()
+    grown[:, :-1] |= grown[:, 1:].copy()
+
+    # the cell that each pixel belongs to
+    xcell = np.searchsorted(xnodes, np.arange(nx), side='right') - 1
+    ycell = np.searchsorted(ynodes, np.arange(ny), side='right') - 1
+    mask = allin[xcell[:, np.newaxis], ycell[np.newaxis, :]]
+    rows, cols = np.nonzero(grown[xcell[:, np.newaxis], ycell[np.newaxis, :]])
+    if len(rows) > 0:
+        mask[rows, cols] = within(rows, cols)
+    return mask
+
+
+def _mask_cache_name(cachedir, shape, wcs, region):
+    """
+    The name of the file that caches the mask for a given image grid and region.
+    :param cachedir: the cache directory
+    :param shape: the shape of the image
+    :param wcs: a WCS object
+    :param region: a MIMAS region
+    :return: filename
+    """
+    # only the parameters that determine the pixel to sky mapping are used, so that images which share a grid
+    # but not eg an observation date will share a mask
+    w = wcs.celestial.wcs
+    params = [region_mask_version, list(w.ctype), w.crpix.tolist(), w.crval.tolist(), w.get_cdelt().tolist(), w.get_pc().tolist(),
+              sorted(w.get_pv()), w.lonpole, w.latpole, w.radesys, w.equinox, tuple(shape)]
+    sip = wcs.celestial.sip
+    if sip is not None:
+        params.extend([sip.a.tolist(), sip.b.tolist()])
+    wcs_hash = hashlib.sha1(repr(params)).hexdigest()
+    region_hash = hashlib.sha1(str(region.maxdepth) + region.get_ranges().tobytes()).hexdigest()
+    return os.path.join(cachedir, 'mask_{0}_{1}.npz'.format(wcs_hash[:16], region_hash[:16]))
+
+
+def cached_region_mask(shape, wcs, region, cachedir=None):
+    """
+    As per region_mask, but the mask is stored in (and reused from) the directory cachedir.
+    The cached masks are keyed by a hash of the region_mask version and the WCS/shape of the image,
+    and a hash of the region.
+    :param shape: the shape of the image
+    :param wcs: a WCS object
+    :param region: a MIMAS region
+    :param cachedir: the cache directory. If None then the mask is not cached.
+    :return: a boolean array of the given shape that is True for pixels within the region
+    """
+    if cachedir is None:
+        return region_mask(shape, wcs, region)
+    fname = _mask_cache_name(cachedir, shape, wcs, region)
+    if os.path.exists(fname):
+        try:
+            with np.load(fname) as f:
+                mask = np.unpackbits(f['mask'])[:np.prod(shape)].reshape(shape).astype(bool)
+            logging.info("Loaded region mask from {0}".format(fname))
+            return mask
+        except (IOError, KeyError, ValueError), e:
+            logging.warn("Cannot read cached mask {0}: {1}".format(fname, e))
+    mask = region_mask(shape, wcs, region)
+    if not os.path.exists(cachedir):
+        os.makedirs(cachedir)
+    # write to a temporary file first so that concurrent jobs never see a partial file
+    tmp = '{0}.{1}.tmp'.format(fname, os.getpid())
+    with open(tmp, 'wb') as f:
+        np.savez_compressed(f, mask=np.packbits(mask))
+    os.rename(tmp, fname)
+    logging.info("Wrote region mask to {0}".format(fname))
+    return mask
+
+
+def mask_file(regionfile, infile, outfile, negate=False, cachedir=None):
     """
     Created a masked version of file, using region.
     This does not change the shape or size of the image, it just sets some pixels to be null/nan
@@ -99,13 +261,14 @@ def mask_file(regionfile, infile, outfile, negate=False):
     :param infile: The name of the fits file to mask.
     :param outfile: The masked file to be written
     :param negate: Keep pixles that are outside the supplied region
+    :param cachedir: A directory in which to cache the rasterised region, see cached_region_mask
     :return: None
     """
     # Check that the input file is accessible and then open it
     assert os.path.exists(infile), "Cannot locate fits file {0}".format(infile)
     im = pyfits.open(infile)
     assert os.path.exists(regionfile), "Cannot locate region file {0}".format(regionfile)
-    region = pickle.load(open(regionfile))
+    region = load_region(regionfile)
     try:
         wcs = pywcs.WCS(im[0].header, naxis=2)
     except:
@@ -117,11 +280,11 @@ def mask_file(regionfile, infile, outfile, negate=False):
         data = im[0].data
 
     print data.shape
-    if len(data.shape) == 3:
-        for plane in range(data.shape[0]):
-            mask_plane(data[plane], wcs, region, negate)
-    else:
-        mask_plane(data, wcs, region, negate)
+    # the mask is the same for every plane of a cube so compute it just once
+    mask = cached_region_mask(data.shape[-2:], wcs, region, cachedir)
+    if not negate:
+        mask = np.bitwise_not(mask)
+    data[..., mask] = np.nan
     im[0].data = data
     im.writeto(outfile, clobber=True)
     logging.info("Wrote {0}".format(outfile))
@@ -147,20 +310,38 @@ def mask_table(region, table, negate=False, racol='ra', deccol='dec'):
     return table[mask]
 
 
-def mask_catalog(regionfile, infile, outfile, negate=False, racol='ra', deccol='dec'):
+def mask_catalog(regionfile, infile, outfile, negate=False, racol='ra', deccol='dec', chunksize=None):
     """
     Apply a region file as a mask to a catalog, removing all the rows with ra/dec inside the region
     If negate=False then remove the rows with ra/dec outside the region.
+    FITS, csv, and hdf5 catalogs are read and written in chunks of rows, provided that the input and output
+    have the same format. Other catalogs are read into memory.
     :param regionfile: name of a .mim file
     :param infile: an catalogue that can be read by AegeanTools.catalogs.load_table
     :param outfile: output filename
     :param negate: reverse the masking
     :param racol: the name of the column containing the ra coordinates - default 'ra'
     :param deccol: the name of the column containing the dec coordinates - default 'dec'
+    :param chunksize: the number of rows to process at a time. Default = Region.chunksize
     :return:
     """
     logging.info("Loading region from {0}".format(regionfile))
-    region = pickle.load(open(regionfile, 'r'))
+    region = load_region(regionfile)
+    if chunksize is None:
+        chunksize = region.chunksize
+
+    fmt = os.path.splitext(infile)[-1][1:].lower()
+    if fmt == os.path.splitext(outfile)[-1][1:].lower():
+        if fmt == 'fits':
+            if _mask_fits_catalog(region, infile, outfile, negate, racol, deccol, chunksize):
+                return
+        elif fmt == 'csv':
+            _mask_csv_catalog(region, infile, outfile, negate, racol, deccol, chunksize)
+            return
+        elif fmt == 'hdf5' and hdf5_supported:
+            _mask_hdf5_catalog(region, infile, outfile, negate, racol, deccol, chunksize)
+            return
+
     logging.info("Loading catalog from {0}".format(infile))
     table = load_table(infile)
     masked_table = mask_table(region, table, negate=negate, racol=racol, deccol=deccol)
@@ -168,15 +349,152 @@ def mask_catalog(regionfile, infile, outfile, negate=False, racol='ra', deccol='
     return
 
 
+def _keep_rows(region, ra, dec, negate):
+    """
+    Determine which rows of a catalog are kept when masking with a region.
+    :param region: an AegeanTools.regions.Region
+    :param ra: array of ra (degrees)
+    :param dec: array of dec (degrees)
+    :param negate: reverse the masking
+    :return: boolean array that is True for rows that are kept
+    """
+    inside = region.sky_within(ra, dec, degin=True)
+    if not negate:
+        return np.bitwise_not(inside)
+    return inside
+
+
+def _mask_fits_catalog(region, infile, outfile, negate, racol, deccol, chunksize):
+    """
+    Mask a fits catalog, copying the kept rows directly from a memory map of the input file.
+    :return: False if the table cannot be streamed (eg it has variable length columns), True otherwise.
+    """
+    hdulist = pyfits.open(infile, memmap=True)
+    hdu = None
+    for h in hdulist:
+        if isinstance(h, (pyfits.BinTableHDU, pyfits.TableHDU)):
+            hdu = h
+            break
+    # ascii tables and variable length arrays can't be copied row by row
+    if not isinstance(hdu, pyfits.BinTableHDU) or any('P' in str(fmt) or 'Q' in str(fmt)
+                                                      for fmt in hdu.columns.formats):
+        hdulist.close()
+        return False
+
+    logging.info("Masking catalog {0} in chunks of {1} rows".format(infile, chunksize))
+    # the raw (on disk) records, without any scaling applied
+    raw = hdu.data.view(np.ndarray)
+    rac, decc = hdu.columns[racol], hdu.columns[deccol]
+    header = hdu.header.copy()
+    for key in ['CHECKSUM', 'DATASUM']:
+        if key in header:
+            del header[key]
+
+    if os.path.exists(outfile):
+        os.remove(outfile)
+    nkeep = 0
+    with open(outfile, 'wb') as f:
+        pyfits.PrimaryHDU().writeto(f)
+        start = f.tell()
+        # the number of rows is updated once we know it
+        f.write(header.tostring())
+        for lo in xrange(0, len(raw), chunksize):
+            chunk = raw[lo:lo + chunksize]
+            ra = chunk[racol].astype(np.float64) * (rac.bscale or 1) + (rac.bzero or 0)
+            dec = chunk[deccol].astype(np.float64) * (decc.bscale or 1) + (decc.bzero or 0)
+            kept = chunk[_keep_rows(region, ra, dec, negate)]
+            f.write(kept.tobytes())
+            nkeep += len(kept)
+        # pad the data to a whole number of fits blocks
+        f.write('\0' * (-f.tell() % 2880))
+        header['NAXIS2'] = nkeep
+        f.seek(start)
+        f.write(header.tostring())
+    hdulist.close()
+    logging.info("Wrote {0}".format(outfile))
+    return True
+
+
+def _mask_csv_catalog(region, infile, outfile, negate, racol, deccol, chunksize):
+    """
+    Mask a csv catalog, copying the kept lines from the input file to the output file.
+    """
+    logging.info("Masking catalog {0} in chunks of {1} rows".format(infile, chunksize))
+
+    def to_float(values):
+        try:
+            return np.array(values, dtype=np.float64)
+        except ValueError:
+            # missing or bad values are treated as nan
+            out = np.empty(len(values))
+            for i, v in enumerate(values):
+                try:
+                    out[i] = float(v)
+                except ValueError:
+                    out[i] = np.nan
+            return out
+
+    with open(infile, 'r') as fin, open(outfile, 'w') as fout:
+        # copy the comments and column names
+        for line in fin:
+            fout.write(line)
+            if line.strip() != '' and not line.startswith('#'):
+                names = [n.strip() for n in csv.reader([line]).next()]
+                break
+        else:
+            return
+        ira, idec = names.index(racol), names.index(deccol)
+        while True:
+            lines = [l for l in itertools.islice(fin, chunksize) if l.strip() != '' and not l.startswith('#')]
+            if len(lines) == 0:
+                break
+            rows = list(csv.reader(lines))
+            ra = to_float([r[ira] for r in rows])
+            dec = to_float([r[idec] for r in rows])
+            fout.writelines(itertools.compress(lines, _keep_rows(region, ra, dec, negate)))
+    logging.info("Wrote {0}".format(outfile))
+    return
+
+
+def _mask_hdf5_catalog(region, infile, outfile, negate, racol, deccol, chunksize):
+    """
+    Mask a hdf5 catalog, copying the kept rows of each table to a resizable dataset in the output file.
+    """
+    logging.info("Masking catalog {0} in chunks of {1} rows".format(infile, chunksize))
+    if os.path.exists(outfile):
+        os.remove(outfile)
+    with h5py.File(infile, 'r') as fin, h5py.File(outfile, 'w') as fout:
+        fout.attrs.update(fin.attrs)
+        tables = []
+        fin.visititems(lambda name, obj: tables.append(name) if isinstance(obj, h5py.Dataset) else None)
+        for name in tables:
+            dset = fin[name]
+            if dset.dtype.names is None or racol not in dset.dtype.names or deccol not in dset.dtype.names:
+                # not a table that we can mask so copy it as is
+                fin.copy(dset, fout, name=name)
+                continue
+            out = fout.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dset.dtype,
+                                      chunks=(min(max(dset.shape[0], 1), chunksize),))
+            out.attrs.update(dset.attrs)
+            for lo in xrange(0, dset.shape[0], chunksize):
+                chunk = dset[lo:lo + chunksize]
+                kept = chunk[_keep_rows(region, chunk[racol], chunk[deccol], negate)]
+                n = out.shape[0]
+                out.resize((n + len(kept),))
+                out[n:] = kept
+    logging.info("Wrote {0}".format(outfile))
+    return
+
+
 def mim2reg(mimfile, regfile):
-    region = pickle.load(open(mimfile, 'r'))
+    region = load_region(mimfile)
     region.write_reg(regfile)
     logging.info("Converted {0} -> {1}".format(mimfile, regfile))
     return
 
 
 def mim2fits(mimfile, fitsfile):
-    region = pickle.load(open(mimfile, 'r'))
+    region = load_region(mimfile)
     region.write_fits(fitsfile, moctool='MIMAS {0}-{1}'.format(__version__, __date__))
     logging.info("Converted {0} -> {1}".format(mimfile, fitsfile))
     return
@@ -208,18 +526,32 @@ def box2poly(line):
     return np.ravel([tl, tr, br, bl]).tolist()
 
 
+def _to_degrees(text, unit):
+    """
+    Convert a string to an angle in degrees.
+    Plain numbers are converted directly since parsing them with Angle is slow.
+    :param text: the angle as a string
+    :param unit: the unit of the angle if it is a plain number
+    :return: angle in degrees
+    """
+    try:
+        return float(text) * unit.to(u.degree)
+    except ValueError:
+        return Angle(text, unit=unit).degree
+
+
 def circle2circle(line):
     words = re.split('[(,\s)]', line)
     ra = words[1]
     dec = words[2]
     radius = words[3][:-1]  # strip the "
     if ":" in ra:
-        ra = Angle(ra, unit=u.hour)
+        ra = Angle(ra, unit=u.hour).degree
     else:
-        ra = Angle(ra, unit=u.degree)
-    dec = Angle(dec, unit=u.degree)
-    radius = Angle(radius, unit=u.arcsecond)
-    return [ra.degree, dec.degree, radius.degree]
+        ra = _to_degrees(ra, u.degree)
+    dec = _to_degrees(dec, u.degree)
+    radius = _to_degrees(radius, u.arcsecond)
+    return [ra, dec, radius]
 
 
 def poly2poly(line):
@@ -244,11 +576,12 @@ def poly2poly(line):
     return coords
 
 
-def reg2mim(regfile, mimfile, maxdepth):
+def reg2mim(regfile, mimfile, maxdepth, cores=1):
     """
     Read a ds9 regions file and create a mim file from it
     :param regfile:
     :param mimfile:
+    :param cores: number of processes used to compute the pixels of the shapes
     :return:
     """
     logging.info("Reading regions from {0}".format(regfile))
@@ -268,6 +601,7 @@ def reg2mim(regfile, mimfile, maxdepth):
     container = Dummy(maxdepth=maxdepth)
     container.include_circles = circles
     container.include_polygons = poly
+    container.cores = cores
 
     region = combine_regions(container)
     save_region(region,mimfile)
@@ -288,54 +622,122 @@ def combine_regions(container):
     # add/rem all the regions from files
     for r in container.add_region:
         logging.info("adding region from {0}".format(r))
-        r2 = pickle.load(open(r[0], 'r'))
+        r2 = load_region(r[0])
         region.union(r2)
 
     for r in container.rem_region:
         logging.info("removing region from {0}".format(r))
-        r2 = pickle.load(open(r[0], 'r'))
+        r2 = load_region(r[0])
         region.without(r2)
 
+    cores = getattr(container, 'cores', 1)
 
     # add circles
     if len(container.include_circles) > 0:
-        for c in container.include_circles:
-            circles = np.radians(np.array(c))
-            if container.galactic:
-                l, b, radii = circles.reshape(3,circles.shape[0]/3)
-                ras, decs = galactic2fk5(l,b)
-            else:
-                ras, decs, radii = circles.reshape(3, circles.shape[0]/3)
-            region.add_circles(ras, decs, radii)
+        circles = [_parse_circles(c, container.galactic) for c in container.include_circles]
+        region.union(shapes2region(container.maxdepth, circles=circles, cores=cores))
 
     # remove circles
     if len(container.exclude_circles) > 0:
-        for c in container.exclude_circles:
-            r2 = Region(container.maxdepth)
-            circles = np.radians(np.array(c))
-            if container.galactic:
-                l, b, radii = circles.reshape(3,circles.shape[0]/3)
-                ras, decs = galactic2fk5(l,b)
-            else:
-                ras, decs, radii = circles.reshape(3, circles.shape[0]/3)
-            r2.add_circles(ras, decs, radii)
-            region.without(r2)
+        circles = [_parse_circles(c, container.galactic) for c in container.exclude_circles]
+        region.without(shapes2region(container.maxdepth, circles=circles, cores=cores))
 
     # add polygons
     if len(container.include_polygons) > 0:
-        for p in container.include_polygons:
-            poly = np.radians(np.array(p))
-            poly = poly.reshape((poly.shape[0]/2, 2))
-            region.add_poly(poly)
+        polygons = [_parse_poly(p) for p in container.include_polygons]
+        region.union(shapes2region(container.maxdepth, polygons=polygons, cores=cores))
 
     # remove polygons
     if len(container.exclude_polygons) > 0:
-        for p in container.include_polygons:
-            poly = np.array(np.radians(p))
-            r2 = Region(container.maxdepth)
-            r2.add_poly(poly)
-            region.without(r2)
+        polygons = [_parse_poly(p) for p in container.exclude_polygons]
+        region.without(shapes2region(container.maxdepth, polygons=polygons, cores=cores))
+    return region
+
+
+def _parse_circles(c, galactic=False):
+    """
+    Convert a list of [ra, dec, radius, ...] in degrees into arrays of ra, dec, radius in radians
+    :param c: list of circle descriptions
+    :param galactic: If True then the coordinates are l/b not ra/dec
+    :return: ras, decs, radii
+    """
+    circles = np.radians(np.array(c, dtype=float))
+    if galactic:
+        l, b, radii = circles.reshape(3, circles.shape[0]/3)
+        ras, decs = galactic2fk5(l, b)
+    else:
+        ras, decs, radii = circles.reshape(3, circles.shape[0]/3)
+    return ras, decs, radii
+
 
+def _parse_poly(p):
+    """
+    Convert a list of [ra, dec, ...] in degrees into an array of [(ra,dec), ...] in radians
+    :param p: list of polygon vertices
+    :return: array of vertices
+    """
+    poly = np.radians(np.array(p, dtype=float))
+    return poly.reshape((poly.shape[0]/2, 2))
+
+
+def _query_shapes(args):
+    """
+    Find the pixels that cover a list of shapes. This is the worker function for shapes2region.
+    :param args: (nside, circles, polygons) where circles is a list of (ra, dec, radius) and polygons is a list
+                 of [(ra, dec), ...], all in radians.
+    :return: a sorted array of unique pixels (nested scheme)
+    """
+    nside, circles, polygons = args
+    pix = [np.empty(0, dtype=np.int64)]
+    if len(circles) > 0:
+        ras, decs, radii = zip(*circles)
+        vectors = Region.sky2vec(zip(ras, decs))
+        pix.extend(hp.query_disc(nside, vec, r, inclusive=True, nest=True) for vec, r in zip(vectors, radii))
+    for poly in polygons:
+        pix.append(hp.query_polygon(nside, Region.sky2vec(poly), inclusive=True, nest=True))
+    return np.unique(np.concatenate(pix).astype(np.int64))
+
+
+def shapes2region(maxdepth, circles=(), polygons=(), cores=1, chunksize=1000):
+    """
+    Create a region from a large number of circles and polygons.
+    The pixels for each chunk of shapes are computed in parallel, merged, and then the region is
+    normalised just once.
+    :param maxdepth: The depth of the region
+    :param circles: list of (ras, decs, radii) arrays, in radians
+    :param polygons: list of polygons, each of which is [(ra, dec), ...] in radians
+    :param cores: number of processes to use. None = all available cores.
+    :param chunksize: the number of shapes processed in each job
+    :return: A region
+    """
+    shapes = []
+    for ras, decs, radii in circles:
+        shapes.extend(('c', s) for s in zip(np.ravel(ras), np.ravel(decs), np.ravel(radii)))
+    for poly in polygons:
+        assert len(poly) >= 3, "A minimum of three coordinate pairs are required"
+        shapes.append(('p', poly))
+
+    nside = 2**maxdepth
+    args = []
+    for i in xrange(0, len(shapes), chunksize):
+        chunk = shapes[i:i + chunksize]
+        args.append((nside, [s for t, s in chunk if t == 'c'], [s for t, s in chunk if t == 'p']))
+
+    if cores is None:
+        cores = multiprocessing.cpu_count()
+    cores = max(min(cores, len(args)), 1)
+    if cores > 1:
+        logging.info("Computing pixels for {0} shapes using {1} cores".format(len(shapes), cores))
+        pool = multiprocessing.Pool(processes=cores)
+        results = pool.map(_query_shapes, args)
+        pool.close()
+        pool.join()
+    else:
+        results = map(_query_shapes, args)
+
+    pix = np.unique(np.concatenate([np.empty(0, dtype=np.int64)] + results))
+    region = Region(maxdepth)
+    region._set_ranges(merge_ranges(pix, pix + 1))
     return region
 
 
@@ -347,22 +749,40 @@ def intersect_regions(flist):
     """
     if len(flist) < 2:
         raise Exception("Require at least two regions to perform intersection")
-    a = pickle.load(open(flist[0]))
-    for b in [pickle.load(open(f)) for f in flist[1:]]:
+    a = load_region(flist[0])
+    for b in [load_region(f) for f in flist[1:]]:
         a.intersect(b)
     return a
 
 
 
 
+def load_region(filename):
+    """
+    Load a region from a file.
+    The file can be a MOC in fits format (as written by save_region or Region.write_fits), or a pickled .mim file.
+    :param filename: A Filename
+    :return: A Region
+    """
+    with open(filename, 'rb') as f:
+        is_fits = f.read(6) == 'SIMPLE'
+    if is_fits:
+        return Region.from_fits(filename)
+    return pickle.load(open(filename, 'rb'))
+
+
 def save_region(region, filename):
     """
-    Save the given region to a file
+    Save the given region to a file.
+    Filenames ending in .fits are saved as a MOC, otherwise the region is pickled (.mim format)
     :param region: A Region
     :param filename: A Filename
     :return: None
     """
-    pickle.dump(region, open(filename, 'w'), protocol=-1)
+    if filename.lower().endswith('.fits'):
+        region.write_fits(filename, moctool='MIMAS {0}-{1}'.format(__version__, __date__))
+    else:
+        pickle.dump(region, open(filename, 'w'), protocol=-1)
     logging.info("Wrote {0}".format(filename))
     return
 
@@ -374,11 +794,124 @@ def save_as_image(region, filename):
     :param filename:
     :return:
     """
-    import healpy as hp
-    pixels = list(region.get_demoted())
+    ranges = region.get_ranges()
     order = region.maxdepth
-    m = np.arange(hp.nside2npix(2**order))
-    m[:] = 0
-    m[pixels] = 1
+    # set the pixels within each range, without listing every pixel
+    edges = np.zeros(hp.nside2npix(2**order) + 1, dtype=np.int64)
+    edges[ranges[:, 0]] += 1
+    edges[ranges[:, 1]] -= 1
+    m = np.cumsum(edges[:-1])
     hp.write_map(filename, m, nest=True, coord='C')
     return
+
+
+def test_mask_cache_name():
+    """
+    Test that images that differ only in their observation date share a cached mask,
+    and that masks from a different version of region_mask are not shared
+    """
+    header = pyfits.getheader(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Test', 'Images',
+                                           '1904-66_SIN.fits'))
+    region = Region(maxdepth=6)
+    region.add_circles(np.radians(286), np.radians(-66), np.radians(2))
+    shape = (header['NAXIS2'], header['NAXIS1'])
+    names = []
+    for date, mjd in [('2015-01-01T00:00:00', 57023.0), ('2016-06-01T12:00:00', 57540.5)]:
+        header['DATE-OBS'] = date
+        header['MJD-OBS'] = mjd
+        names.append(_mask_cache_name('cache', shape, pywcs.WCS(header, naxis=2), region))
+    assert names[0] == names[1], "Headers with different DATE-OBS have different cache names"
+    global region_mask_version
+    region_mask_version += 1
+    try:
+        assert _mask_cache_name('cache', shape, pywcs.WCS(header, naxis=2), region) != names[0], \
+            "Different versions of region_mask have the same cache name"
+    finally:
+        region_mask_version -= 1
+    header['CRVAL1'] += 1
+    assert _mask_cache_name('cache', shape, pywcs.WCS(header, naxis=2), region) != names[0], \
+        "Headers with different CRVAL1 have the same cache name"
+    print "test_mask_cache_name PASSED"
+    return
+
+
+def test_region_mask():
+    """
+    Test that region_mask gives the same result as evaluating every pixel of an image
+    """
+    for proj in ['CAR', 'AIT']:
+        header = pyfits.getheader(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Test', 'Images',
+                                               '1904-66_{0}.fits'.format(proj)))
+        wcs = pywcs.WCS(header, naxis=2)
+        shape = (header['NAXIS2'], header['NAXIS1'])
+        rows, cols = np.indices(shape)
+        ra, dec = wcs.wcs_pix2world(np.column_stack([cols.ravel(), rows.ravel()]), 1).transpose()
+        ra0, dec0 = wcs.wcs_pix2world([[shape[1] / 2., shape[0] / 2.]], 1)[0]
+        for depth in range(4, 10):
+            # circles that are within the image, that cross the edge, and that cover the image
+            for radius in [1, 3, 6, 10]:
+                region = Region(maxdepth=depth)
+                region.add_circles(np.radians(ra0 + 2), np.radians(dec0 + 1), np.radians(radius))
+                expected = region.sky_within(ra, dec, degin=True).reshape(shape)
+                mask = region_mask(shape, wcs, region)
+                assert np.all(mask == expected), \
+                    "region_mask differs from sky_within at {0} pixels for {1} depth={2} radius={3}".format(
+                        np.sum(mask != expected), proj, depth, radius)
+    print "test_region_mask PASSED"
+    return
+
+
+def test_mask_plane():
+    """
+    Test that mask_plane and mask_file give the same result as masking every pixel separately,
+    which is how mask_plane used to work
+    """
+    import tempfile
+    imdir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Test', 'Images')
+
+    def per_pixel(data, wcs, region, negate):
+        rows, cols = np.indices(data.shape[-2:])
+        ra, dec = wcs.wcs_pix2world(np.column_stack([cols.ravel(), rows.ravel()]), 1).transpose()
+        bigmask = region.sky_within(ra, dec, degin=True).reshape(data.shape[-2:])
+        if not negate:
+            bigmask = np.bitwise_not(bigmask)
+        data[..., bigmask] = np.nan
+        return data
+
+    for proj in ['SIN', 'CAR', 'AIT']:
+        im = pyfits.open(os.path.join(imdir, '1904-66_{0}.fits'.format(proj)))
+        wcs = pywcs.WCS(im[0].header, naxis=2)
+        # use an image of ones so that nan pixels in the test images do not hide any differences
+        data = np.ones(np.squeeze(im[0].data).shape)
+        ra0, dec0 = wcs.wcs_pix2world([[data.shape[1] / 2., data.shape[0] / 2.]], 1)[0]
+        for depth in [4, 6, 8]:
+            region = Region(maxdepth=depth)
+            region.add_circles(np.radians(ra0 + 2), np.radians(dec0 + 1), np.radians(6))
+            for negate in [False, True]:
+                expected = per_pixel(data.copy(), wcs, region, negate)
+                masked = mask_plane(data.copy(), wcs, region, negate)
+                assert np.all(np.isnan(masked) == np.isnan(expected)), \
+                    "mask_plane differs for {0} depth={1} negate={2}".format(proj, depth, negate)
+
+    # a cube is masked the same way in every plane
+    tmpdir = tempfile.mkdtemp()
+    cubefile = os.path.join(imdir, '1904-66_SIN_cube.fits')
+    header = pyfits.getheader(cubefile)
+    wcs = pywcs.WCS(header, naxis=2)
+    region = Region(maxdepth=8)
+    region.add_circles(np.radians(286), np.radians(-65), np.radians(4))
+    save_region(region, os.path.join(tmpdir, 'region.mim'))
+    mask_file(os.path.join(tmpdir, 'region.mim'), cubefile, os.path.join(tmpdir, 'masked.fits'))
+    expected = per_pixel(np.squeeze(pyfits.getdata(cubefile)), wcs, region, False)
+    masked = pyfits.getdata(os.path.join(tmpdir, 'masked.fits'))
+    assert np.all(np.isnan(masked) == np.isnan(expected)), "mask_file differs for a cube"
+    print "test_mask_plane PASSED"
+    return
+
+
+if __name__ == "__main__":
+    print 'Running tests....'
+    test_mask_cache_name()
+    test_region_mask()
+    test_mask_plane()
+    print 'all tests PASSED'
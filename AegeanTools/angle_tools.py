@@ -15,6 +15,8 @@ __author__ = "Paul Hancock"
 
 import math
 import numpy as np
+from scipy.spatial import ConvexHull
+from scipy.spatial.qhull import QhullError
 
 
 def ra2dec(ra):
@@ -91,10 +93,74 @@ def gcd(ra1, dec1, ra2, dec2):
     dlat = dec2 - dec1
     a = np.sin(np.radians(dlat) / 2) ** 2
     a += np.cos(np.radians(dec1)) * np.cos(np.radians(dec2)) * np.sin(np.radians(dlon) / 2) ** 2
-    sep = np.degrees(2 * np.arcsin(min(1, np.sqrt(a))))
+    sep = np.degrees(2 * np.arcsin(np.fmin(1, np.sqrt(a))))
     return sep
 
 
+def gcd_pairwise(ra1, dec1, ra2=None, dec2=None):
+    """
+    Great circle distance between every pair of points from two lists of coordinates.
+    If ra2/dec2 are not given then the distances are between all pairs of points in ra1/dec1.
+    ra/dec in degrees
+    returns:
+    sep in degrees, an array of shape (len(ra1), len(ra2))
+    """
+    ra1 = np.asarray(ra1, dtype=float).ravel()
+    dec1 = np.asarray(dec1, dtype=float).ravel()
+    if ra2 is None:
+        ra2, dec2 = ra1, dec1
+    ra2 = np.asarray(ra2, dtype=float).ravel()
+    dec2 = np.asarray(dec2, dtype=float).ravel()
+    return gcd(ra1[:, None], dec1[:, None], ra2[None, :], dec2[None, :])
+
+
+def farthest_pair(ra, dec):
+    """
+    Find the two points that are the greatest distance apart.
+    The points are first reduced to those on their convex hull (in a gnomonic projection about their centroid),
+    and then the distances between all pairs of these points are compared.
+    The pair returned is the first pair (i,j) with i<=j, in the order that they appear in ra/dec,
+    so that the result is the same as comparing all pairs of points in a double loop.
+    ra/dec in degrees
+    returns:
+    i, j, sep - the indices of the two points and their separation in degrees
+    """
+    ra = np.asarray(ra, dtype=float).ravel()
+    dec = np.asarray(dec, dtype=float).ravel()
+    if ra.size == 0:
+        return None, None, 0.
+    candidates = np.arange(ra.size)
+    # non-finite positions are left to gcd, which gives them a separation of 180deg
+    if ra.size > 3 and np.all(np.isfinite(ra) & np.isfinite(dec)):
+        rra = np.radians(ra)
+        rdec = np.radians(dec)
+        vec = np.column_stack([np.cos(rdec) * np.cos(rra), np.cos(rdec) * np.sin(rra), np.sin(rdec)])
+        centre = vec.mean(axis=0)
+        centre /= np.sqrt(np.sum(centre ** 2))
+        cosc = np.dot(vec, centre)
+        # the gnomonic projection only works for points within 90deg of the centre
+        if np.all(cosc > 0):
+            e1 = np.cross([0., 0., 1.], centre)
+            if np.sum(e1 ** 2) < 1e-12:
+                e1 = np.array([1., 0., 0.])
+            e1 /= np.sqrt(np.sum(e1 ** 2))
+            e2 = np.cross(centre, e1)
+            plane = np.column_stack([np.dot(vec, e1) / cosc, np.dot(vec, e2) / cosc])
+            try:
+                vertices = ConvexHull(plane).vertices
+            except QhullError:
+                # all the points are on a line, or there are too few of them
+                vertices = None
+            if vertices is not None:
+                # points that are repeated need to be kept so that the order of the pairs is preserved
+                on_hull = set(zip(ra[vertices], dec[vertices]))
+                candidates = np.array([k for k in candidates if (ra[k], dec[k]) in on_hull])
+    sep = gcd_pairwise(ra[candidates], dec[candidates])
+    sep[np.tril_indices(candidates.size, -1)] = -1
+    i, j = np.unravel_index(np.argmax(sep), sep.shape)
+    return candidates[i], candidates[j], max(sep[i, j], 0.)
+
+
 def bear(ra1, dec1, ra2, dec2):
     """
     Calculate the bearing of point b from point a.
@@ -144,13 +210,10 @@ def dist_rhumb(ra1, dec1, ra2, dec2):
     lambda1 = np.radians(ra1)
     lambda2 = np.radians(ra2)
     dpsi = np.log(np.tan(np.pi / 4 + phi2 / 2) / np.tan(np.pi / 4 + phi1 / 2))
-    if dpsi < 1e-12:
-        q = np.cos(phi1)
-    else:
-        q = dpsi / dphi
+    with np.errstate(divide='ignore', invalid='ignore'):
+        q = np.where(dpsi < 1e-12, np.cos(phi1), dpsi / dphi)
     dlambda = lambda2 - lambda1
-    if dlambda > np.pi:
-        dlambda -= 2 * np.pi
+    dlambda = np.where(dlambda > np.pi, dlambda - 2 * np.pi, dlambda)
     dist = np.hypot(dphi, q * dlambda)
     return np.degrees(dist)
 
@@ -196,11 +259,9 @@ def translate_rhumb(ra, dec, r, theta):
     phi2 = phi1 + delta * np.cos(np.radians(theta))
     dphi = phi2 - phi1
 
-    if abs(dphi) < 1e-9:
-        q = np.cos(phi1)
-    else:
+    with np.errstate(divide='ignore', invalid='ignore'):
         dpsi = np.log(np.tan(np.pi / 4 + phi2 / 2) / np.tan(np.pi / 4 + phi1 / 2))
-        q = dphi / dpsi
+        q = np.where(abs(dphi) < 1e-9, np.cos(phi1), dphi / dpsi)
 
     lambda1 = np.radians(ra)
     dlambda = delta * np.sin(np.radians(theta)) / q
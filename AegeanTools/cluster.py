@@ -35,15 +35,27 @@ def norm_dist(src1, src2):
     """
     if src1 == src2:
         return 0
-    dist = gcd(src1.ra, src1.dec, src2.ra, src2.dec) # degrees
+    return norm_dist_arrays(src1.ra, src1.dec, src1.a, src1.b, src1.pa,
+                            src2.ra, src2.dec, src2.a, src2.b, src2.pa)
+
+
+def norm_dist_arrays(ra1, dec1, a1, b1, pa1, ra2, dec2, a2, b2, pa2):
+    """
+    Array version of norm_dist, which accepts the source parameters instead of source objects.
+    All parameters are broadcast against each other.
+    :param ra1, dec1, a1, b1, pa1: parameters of the first source(s) in degrees/arcsec/arcsec/degrees
+    :param ra2, dec2, a2, b2, pa2: parameters of the second source(s)
+    :return: normalised distance(s)
+    """
+    dist = gcd(ra1, dec1, ra2, dec2)  # degrees
 
     # the angle between the ellipse centers
-    phi = bear(src1.ra, src1.dec, src2.ra, src2.dec) # Degrees
+    phi = bear(ra1, dec1, ra2, dec2)  # Degrees
     # Calculate the radius of each ellipse along a line that joins their centers.
-    r1 = src1.a*src1.b / np.hypot(src1.a * np.sin(np.radians(phi - src1.pa)),
-                                  src1.b * np.cos(np.radians(phi - src1.pa)))
-    r2 = src2.a*src2.b / np.hypot(src2.a * np.sin(np.radians(180 + phi - src2.pa)),
-                                  src2.b * np.cos(np.radians(180 + phi - src2.pa)))
+    r1 = a1*b1 / np.hypot(a1 * np.sin(np.radians(phi - pa1)),
+                          b1 * np.cos(np.radians(phi - pa1)))
+    r2 = a2*b2 / np.hypot(a2 * np.sin(np.radians(180 + phi - pa2)),
+                          b2 * np.cos(np.radians(180 + phi - pa2)))
     R = dist / (np.hypot(r1, r2) / 3600)
     return R
 
@@ -72,21 +84,25 @@ def pairwise_ellpitical_binary(sources, eps, far=None):
         far = max(a.a/3600 for a in sources)
     l = len(sources)
     distances = np.ones((l, l), dtype=bool)
-    for i in xrange(l):
-        for j in xrange(i,l):
-            if j<i:
-                continue
-            if i == j:
-                distances[i, j] = False
-                continue
-            src1 = sources[i]
-            src2 = sources[j]
-            if src2.dec - src1.dec > far:
-                break
-            if abs(src2.ra - src1.ra)*np.cos(np.radians(src1.dec)) > far:
-                continue
-            distances[i, j] = norm_dist(src1, src2) > eps
-            distances[j, i] = distances[i, j]
+    np.fill_diagonal(distances, False)
+    if l < 2:
+        return distances
+    ra, dec, a, b, pa = np.array([(s.ra, s.dec, s.a, s.b, s.pa) for s in sources], dtype=float).T
+    # only the upper triangle is calculated, and then mirrored
+    i, j = np.triu_indices(l, 1)
+    # since the sources are sorted by declination, this has the same effect as a break in the j loop
+    near = ~((dec[j] - dec[i]) > far)
+    near &= ~(abs(ra[j] - ra[i])*np.cos(np.radians(dec[i])) > far)
+    i, j = i[near], j[near]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ndist = norm_dist_arrays(ra[i], dec[i], a[i], b[i], pa[i], ra[j], dec[j], a[j], b[j], pa[j])
+    # sources that are equal have a distance of zero
+    island = np.array([getattr(s, 'island', None) for s in sources])
+    for k in np.where(island[i] == island[j])[0]:
+        if sources[i[k]] == sources[j[k]]:
+            ndist[k] = 0
+    distances[i, j] = ndist > eps
+    distances[j, i] = distances[i, j]
     return distances
 
 
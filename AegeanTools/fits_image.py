@@ -7,6 +7,7 @@ Modified by: Paul Hancock 2012 onwards
 
 import numpy
 import astropy.wcs as pywcs
+from astropy.io import fits
 import scipy.stats
 import logging
 import sys
@@ -114,14 +115,25 @@ class FitsImage():
     An object that handles the loading and manipulation of a fits file,
     """
 
-    def __init__(self, filename=None, hdu_index=0, beam=None, slice=None):
+    # number of rows that are checked for +/- inf, or have the background subtracted, at a time
+    block = 256
+
+    def __init__(self, filename=None, hdu_index=0, beam=None, slice=None, memmap=False, dtype=None):
         """
         filename: the name of the fits image file or an instance of astropy.io.fits.HDUList
         hdu_index = index of FITS HDU when extensions are used (0 is primary HDU)
         hdu = a pyfits hdu. if provided the object is constructed from this instead of
               opening the file (filename is ignored)  
+        memmap = True: memory map the file rather than reading it. The map is copy-on-write, so pixels that are
+                 changed (eg +/- inf replaced, or the background subtracted) are copied into memory, and only
+                 images that are not changed (eg background and rms images) are read from the file as needed.
+                 Changes to the pixels are not written to the file.
+        dtype = the data type to use for the pixels (eg numpy.float32), default is the type used in the file
         """
-
+        self.memmap = memmap
+        self.dtype = dtype
+        if memmap and isinstance(filename, basestring):
+            filename = fits.open(filename, memmap=True)
         self.hdu = expand(filename)[hdu_index] # auto detects if the file needs expanding
 
         self._header = self.hdu.header
@@ -167,11 +179,24 @@ class FitsImage():
         elif len(self._pixels.shape) > 3:
             log.critical("Image has >3 axes.")
             sys.exit(1)
-        # convert +/- inf to nan
-        self._pixels[numpy.where(numpy.isinf(self._pixels))] = numpy.nan
+        if dtype is not None and self._pixels.dtype != numpy.dtype(dtype):
+            self._pixels = self._pixels.astype(dtype)
+        self._fix_infs()
         # del self.hdu
         log.debug("Using axes {0} and {1}".format(self._header['CTYPE1'], self._header['CTYPE2']))
 
+    def _fix_infs(self):
+        """
+        Convert +/- inf to nan, a block of rows at a time.
+        """
+        for lo in xrange(0, self._pixels.shape[0], self.block):
+            rows = self._pixels[lo:lo + self.block]
+            infs = numpy.isinf(rows)
+            # only write to the pixels if we need to (so that memory mapped pages are not copied)
+            if infs.any():
+                rows[infs] = numpy.nan
+        return
+
     def get_pixels(self):
         return self._pixels
 
@@ -182,6 +207,20 @@ class FitsImage():
         """
         assert pixels.shape == self._pixels.shape, "Shape mismatch between pixels supplied {0} and existing image pixels {1}".format(pixels.shape,self._pixels.shape)
         self._pixels = pixels
+
+    def subtract(self, other):
+        """
+        Subtract an image (eg the background) from the pixels.
+        This is done in place, a block of rows at a time, unless this would change the data type of the pixels.
+        :param other: an array the same shape as the pixels
+        """
+        pixels = self.get_pixels()
+        if not numpy.can_cast(numpy.result_type(pixels, other), pixels.dtype, casting='equiv'):
+            self.set_pixels(pixels - other)
+            return
+        for lo in xrange(0, pixels.shape[0], self.block):
+            numpy.subtract(pixels[lo:lo + self.block], other[lo:lo + self.block], out=pixels[lo:lo + self.block])
+        return
             
     def get_background_rms(self):
         """
@@ -10,6 +10,9 @@ import copy
 import math
 import numpy as np
 from scipy.linalg import eigh, inv
+import scipy.sparse
+from scipy.sparse.linalg import splu
+from scipy.sparse.csgraph import reverse_cuthill_mckee
 import lmfit
 from angle_tools import gcd, bear
 
@@ -22,6 +25,9 @@ import logging
 
 log = logging.getLogger('Aegean')
 
+# islands with more than this many pixels will use a sparse correlation matrix
+SPARSE_COV_PIX = 1000
+
 
 # Modelling and fitting functions
 def elliptical_gaussian(x, y, amp, xo, yo, sx, sy, theta):
@@ -83,6 +89,125 @@ def Bmatrix(C):
     return B
 
 
+def Cmatrix_sparse(x, y, sx, sy, theta, minval=1e-6):
+    """
+    Construct a sparse correlation matrix corresponding to the data.
+    The matrix assumes a gaussian correlation function, which is truncated where it falls below minval.
+    This is the large island equivalent of Cmatrix.
+    :param x:
+    :param y:
+    :param sx: \sigma_x for pix beam
+    :param sy: \sigma_y for pix beam
+    :param theta: \theta for pix beam
+    :param minval: correlations smaller than this are set to zero
+    :return: A scipy.sparse.csc_matrix
+    """
+    x = np.asarray(x, dtype=int)
+    y = np.asarray(y, dtype=int)
+    npix = len(x)
+    # all the pixel offsets for which the correlation is significant
+    r = int(np.ceil(np.sqrt(-2 * np.log(minval)) * max(sx, sy)))
+    dx, dy = np.mgrid[-r:r + 1, -r:r + 1]
+    corr = elliptical_gaussian(dx, dy, 1, 0, 0, sx, sy, theta)
+    keep = np.where(corr >= minval)
+
+    # an image of pixel indices, padded so that all the offsets stay within bounds
+    xmin, ymin = x.min(), y.min()
+    index = -1 * np.ones((x.max() - xmin + 2 * r + 1, y.max() - ymin + 2 * r + 1), dtype=int)
+    xi = x - xmin + r
+    yi = y - ymin + r
+    index[xi, yi] = np.arange(npix)
+
+    rows, cols, vals = [], [], []
+    for i, j, c in zip(dx[keep], dy[keep], corr[keep]):
+        k = index[xi + i, yi + j]
+        mask = np.where(k >= 0)[0]
+        rows.append(mask)
+        cols.append(k[mask])
+        vals.append(np.repeat(c, len(mask)))
+    C = scipy.sparse.csc_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                                shape=(npix, npix))
+    return C
+
+
+class SparseBmatrix(object):
+    """
+    A replacement for the B matrix (see Bmatrix) that is built from a sparse correlation matrix.
+    The correlation matrix is factored as P.C.P' = L.D.L' so that a.dot(B) can be replaced with
+    D^(-1/2).L^(-1).P.a, which has the same norm.
+    Use whiten(a, B) to apply either type of B matrix.
+    """
+
+    def __init__(self, C, reg=1e-5):
+        """
+        :param C: A sparse correlation matrix (see Cmatrix_sparse)
+        :param reg: regularisation, as a fraction of the largest eigenvalue, that is added to the diagonal of C
+        """
+        C = scipy.sparse.csc_matrix(C)
+        npix = C.shape[0]
+        # reorder the pixels to reduce the fill-in of the factorisation
+        self.perm = reverse_cuthill_mckee(C.tocsr(), symmetric_mode=True)
+        C = C[self.perm, :][:, self.perm]
+        # Gershgorin bound on the largest eigenvalue
+        lmax = abs(C).sum(axis=1).max()
+        # The truncated gaussian correlation matrix is badly conditioned, so regularise it
+        # until we can factor it without pivoting. This is the sparse equivalent of the
+        # minimum eigenvalue that is enforced in Bmatrix.
+        while True:
+            Creg = C + reg * lmax * scipy.sparse.identity(npix, format='csc')
+            lu = splu(Creg, permc_spec='NATURAL', diag_pivot_thresh=0, options=dict(SymmetricMode=True))
+            d = lu.U.diagonal()
+            if np.all(d > 0) or reg >= 1e-2:
+                break
+            reg *= 10
+        self.d = np.sqrt(np.clip(d, reg * lmax, None))
+        self.L = splu(lu.L.tocsc(), permc_spec='NATURAL', diag_pivot_thresh=0)
+        self.shape = C.shape
+
+    def rdot(self, a):
+        """
+        The equivalent of a.dot(B)
+        :param a: A vector, or a stack of row vectors
+        :return: The whitened vector(s)
+        """
+        a = np.asarray(a, dtype=np.float64)
+        if a.ndim == 1:
+            return self.L.solve(a[self.perm]) / self.d
+        return np.transpose(self.L.solve(np.ascontiguousarray(a[:, self.perm].T)) / self.d[:, None])
+
+
+def whiten(a, B):
+    """
+    Apply a B matrix to a vector or stack of row vectors.
+    :param a: data
+    :param B: A B matrix (see Bmatrix), or a SparseBmatrix
+    :return: a.dot(B)
+    """
+    if isinstance(B, SparseBmatrix):
+        return B.rdot(a)
+    return a.dot(B)
+
+
+def correlation_matrices(x, y, sx, sy, theta):
+    """
+    Create the correlation (C) and whitening (B) matrices for the given pixels.
+    Islands with more than SPARSE_COV_PIX pixels get a sparse C and a SparseBmatrix.
+    :param x:
+    :param y:
+    :param sx: \sigma_x for pix beam
+    :param sy: \sigma_y for pix beam
+    :param theta: \theta for pix beam
+    :return: C, B
+    """
+    if len(x) > SPARSE_COV_PIX:
+        C = Cmatrix_sparse(x, y, sx, sy, theta)
+        B = SparseBmatrix(C)
+    else:
+        C = Cmatrix(x, y, sx, sy, theta)
+        B = Bmatrix(C)
+    return C, B
+
+
 def jacobian(pars, x, y):
     """
     Analytical calculation of the Jacobian for an elliptical gaussian
@@ -196,7 +321,7 @@ def lmfit_jacobian(pars, x, y, errs=None, B=None, emp=False):
         # matrix = matrix.dot(errs)
 
     if B is not None:
-        matrix = matrix.dot(B)
+        matrix = whiten(matrix, B)
 
     matrix = np.transpose(matrix)
     return matrix
@@ -510,22 +635,24 @@ def emp_hessian(pars, x, y):
 def nan_acf(noise):
     """
     Calculate the autocorrelation function of the noise
-    where the noise is a 2d array that may contain nans
+    where the noise is a 2d array that may contain nans.
+    The correlation is computed with FFTs, treating nans as zero.
+    Lags for which either of the overlapping regions is entirely nan are set to nan.
     :param noise:
     :return:
     """
-    corr = np.zeros(noise.shape)
-    ix,jx = noise.shape
-    for i in xrange(ix):
-        si_min = slice(i, None, None)
-        si_max = slice(None, ix-i, None)
-        for j in xrange(jx):
-            sj_min = slice(j, None, None)
-            sj_max = slice(None, jx-j, None)
-            if np.all(np.isnan(noise[si_min, sj_min])) or np.all(np.isnan(noise[si_max, sj_max])):
-                corr[i, j] = np.nan
-            else:
-                corr[i, j] = np.nansum(noise[si_min, sj_min] * noise[si_max, sj_max])
+    ix, jx = noise.shape
+    mask = np.isfinite(noise)
+    data = np.where(mask, noise, 0)
+    # zero pad so that the circular correlation has no wrap around
+    shape = (2 * ix, 2 * jx)
+    f = np.fft.rfft2(data, shape)
+    corr = np.fft.irfft2(f * np.conj(f), shape)[:ix, :jx]
+    # the number of finite pixels in noise[i:, j:] and noise[:ix-i, :jx-j] for each lag (i,j)
+    m = mask.astype(np.int64)
+    upper = m[::-1, ::-1].cumsum(axis=0).cumsum(axis=1)[::-1, ::-1]
+    lower = m.cumsum(axis=0).cumsum(axis=1)[::-1, ::-1]
+    corr[(upper == 0) | (lower == 0)] = np.nan
     # return the normalised acf
     return corr / np.nanmax(corr)
 
@@ -540,17 +667,12 @@ def make_ita(noise, acf=None):
     """
     if acf is None:
         acf = nan_acf(noise)
-    # s should be the number of non-masked pixels
-    s = np.count_nonzero(np.isfinite(noise))
     # the indices of the non-masked pixels
     xm, ym = np.where(np.isfinite(noise))
-    ita = np.zeros((s, s))
-    # iterate over the pixels
-    for i, (x1, y1) in enumerate(zip(xm, ym)):
-        for j, (x2, y2) in enumerate(zip(xm, ym)):
-            k = abs(x1-x2)
-            l = abs(y1-y2)
-            ita[i, j] = acf[k, l]
+    # look up the correlation for the separation of every pair of pixels
+    k = abs(xm[:, None] - xm[None, :])
+    l = abs(ym[:, None] - ym[None, :])
+    ita = acf[k, l]
     return ita
 
 
@@ -564,7 +686,7 @@ def RB_bias(data, pars, ita=None, acf=None):
     :param acf: the (normalized) noise correlation function
     :return:
     """
-    log.info("data {0}".format(data.shape))
+    log.debug("data {0}".format(data.shape))
     nparams = np.sum([pars[k].vary for k in pars.keys() if k != 'components'])
     # masked pixels
     xm, ym = np.where(np.isfinite(data))
@@ -576,23 +698,29 @@ def RB_bias(data, pars, ita=None, acf=None):
     h = hessian(pars, x, y)
     # mask the hessian to be AxAxN array
     h = h[:, :, xm, ym]
-    Hij = np.einsum('ik,jk', j, j)
+    # The contractions below are done pairwise with tensordot/dot
+    # which is much faster than a single multi-operand einsum
+    Hij = j.dot(j.T)
     Dij = np.linalg.inv(Hij)
-    Bijk = np.einsum('ip,jkp', j, h)
+    Bijk = np.tensordot(j, h, axes=([1], [2]))
     Eilkm = np.einsum('il,km', Dij, Dij)
 
-    Cimn_1 =    -1 * np.einsum('krj,ir,km,jn', Bijk, Dij, Dij, Dij)
-    Cimn_2 = -1./2 * np.einsum('rkj,ir,km,jn', Bijk, Dij, Dij, Dij)
-    Cimn = Cimn_1 + Cimn_2
+    # Cimn_1 = -1 * einsum('krj,ir,km,jn', Bijk, Dij, Dij, Dij)
+    Cimn_1 = np.tensordot(Dij, Bijk, axes=([1], [1]))  # ikj
+    Cimn_1 = np.tensordot(np.tensordot(Cimn_1, Dij, axes=([1], [0])), Dij, axes=([1], [0]))
+    # Cimn_2 = -1/2 * einsum('rkj,ir,km,jn', Bijk, Dij, Dij, Dij)
+    Cimn_2 = np.tensordot(Dij, Bijk, axes=([1], [0]))  # ikj
+    Cimn_2 = np.tensordot(np.tensordot(Cimn_2, Dij, axes=([1], [0])), Dij, axes=([1], [0]))
+    Cimn = -1 * Cimn_1 - 1./2 * Cimn_2
 
     if ita is None:
         # N is the noise (data-model)
         N = data - ntwodgaussian_lmfit(pars)(x, y)
         ita = make_ita(N, acf=acf)
-        log.info('acf.shape {0}'.format(acf.shape))
-        log.info('acf[0] {0}'.format(acf[0]))
-        log.info('ita.shape {0}'.format(ita.shape))
-        log.info('ita[0] {0}'.format(ita[0]))
+        log.debug('acf.shape {0}'.format(acf.shape))
+        log.debug('acf[0] {0}'.format(acf[0]))
+        log.debug('ita.shape {0}'.format(ita.shape))
+        log.debug('ita[0] {0}'.format(ita[0]))
 
     # Included for completeness but not required
 
@@ -601,13 +729,14 @@ def RB_bias(data, pars, ita=None, acf=None):
     # Pi = np.einsum('ip,p', j, N)
     # Qij = np.einsum('ijp,p', h, N)
 
-    Vij = np.einsum('ip,jq,pq', j, j, ita)
-    Uijk = np.einsum('ip,jkq,pq', j, h, ita)
+    jita = j.dot(ita)
+    Vij = jita.dot(j.T)
+    Uijk = np.tensordot(jita, h, axes=([1], [2]))
 
-    bias_1 = np.einsum('imn, mn', Cimn, Vij)
+    bias_1 = np.tensordot(Cimn, Vij, axes=([1, 2], [0, 1]))
     bias_2 = np.einsum('ilkm, mlk', Eilkm, Uijk)
     bias = bias_1 + bias_2
-    log.info('bias {0}'.format(bias))
+    log.debug('bias {0}'.format(bias))
     return bias
 
 
@@ -639,7 +768,8 @@ def CRB_errs(jac, C, B=None):
     :return: array of errors for the model parameters
     """
     if B is not None:
-        fim_inv = inv(np.transpose(jac).dot(B).dot(np.transpose(B)).dot(jac))
+        wjac = whiten(np.transpose(jac), B)
+        fim_inv = inv(wjac.dot(np.transpose(wjac)))
     else:
         fim = np.transpose(jac).dot(inv(C)).dot(jac)
         fim_inv = inv(fim)
@@ -710,197 +840,272 @@ def condon_errors(source, theta_n, psf=None):
     return
 
 
-def errors(source, model, wcshelper):
+def _ellipse_on_sky(ra, dec, ra_a, dec_a, ra_b, dec_b):
     """
-    Convert pixel based errors into sky coord errors
-    :param source: Source object
-    :param wcshelper: WCSHelper object
-    :return:
+    Array version of the ellipse math in WCSHelper.pix2sky_ellipse.
+    (ra_a, dec_a) and (ra_b, dec_b) are the sky positions of the ends of the
+    major and minor axes of an ellipse centered at (ra, dec).
+    :return: major, minor, pa (all degrees)
     """
+    major = gcd(ra, dec, ra_a, dec_a)
+    pa = bear(ra, dec, ra_a, dec_a)
+    minor = gcd(ra, dec, ra_b, dec_b)
+    pa2 = bear(ra, dec, ra_b, dec_b) - 90
+    # The a/b vectors are perpendicular in sky space, but not always in pixel space
+    minor *= abs(np.cos(np.radians(pa - pa2)))
+    return major, minor, pa
 
-    # if the source wasn't fit then all errors are -1
-    if source.flags & (flags.NOTFIT | flags.FITERR):
-        source.err_peak_flux = source.err_a = source.err_b = source.err_pa = -1
-        source.err_ra = source.err_dec = source.err_int_flux = -1
-        return source
-    # copy the errors from the model
-    prefix = "c{0}_".format(source.source)
-    err_amp = model[prefix + 'amp'].stderr
-    xo, yo = model[prefix + 'xo'].value, model[prefix + 'yo'].value
-    err_xo = model[prefix + 'xo'].stderr
-    err_yo = model[prefix + 'yo'].stderr
-
-    sx, sy = model[prefix + 'sx'].value, model[prefix + 'sy'].value
-    err_sx = model[prefix + 'sx'].stderr
-    err_sy = model[prefix + 'sy'].stderr
-
-    theta = model[prefix + 'theta'].value
-    err_theta = model[prefix + 'theta'].stderr
-
-    source.err_peak_flux = err_amp
-    pix_errs = [err_xo, err_yo, err_sx, err_sy, err_theta]
-
-    log.debug("Pix errs: {0}".format(pix_errs))
-
-    ref = wcshelper.pix2sky([xo, yo])
-    # check to see if the reference position has a valid WCS coordinate
-    # It is possible for this to fail, even if the ra/dec conversion works elsewhere
-    if not all(np.isfinite(ref)):
-        source.flags |= flags.WCSERR
-        source.err_peak_flux = source.err_a = source.err_b = source.err_pa = -1
-        source.err_ra = source.err_dec = source.err_int_flux = -1
-        return source
-
-    # position errors
-    if model[prefix + 'xo'].vary and model[prefix + 'yo'].vary \
-            and all(np.isfinite([err_xo, err_yo])):
-        offset = wcshelper.pix2sky([xo + err_xo, yo + err_yo])
-        source.err_ra = gcd(ref[0], ref[1], offset[0], ref[1])
-        source.err_dec = gcd(ref[0], ref[1], ref[0], offset[1])
-    else:
-        source.err_ra = source.err_dec = -1
 
-    if model[prefix + 'theta'].vary and np.isfinite(err_theta):
-        # pa error
-        off1 = wcshelper.pix2sky([xo + sx * np.cos(np.radians(theta)), yo + sy * np.sin(np.radians(theta))])
-        off2 = wcshelper.pix2sky(
-            [xo + sx * np.cos(np.radians(theta + err_theta)), yo + sy * np.sin(np.radians(theta + err_theta))])
-        source.err_pa = abs(bear(ref[0], ref[1], off1[0], off1[1]) - bear(ref[0], ref[1], off2[0], off2[1]))
-    else:
-        source.err_pa = -1
+def _gather_components(sources, model):
+    """
+    Collect the fitted values, errors, and vary status for a list of sources.
+    Missing errors are returned as nan.
+    :param sources: list of Source objects
+    :param model: lmfit.Parameters
+    :return: dict of {name: (value, stderr, vary)} arrays
+    """
+    pars = {}
+    for name in ['amp', 'xo', 'yo', 'sx', 'sy', 'theta']:
+        params = [model["c{0}_{1}".format(src.source, name)] for src in sources]
+        value = np.array([p.value for p in params], dtype=float)
+        stderr = np.array([np.nan if p.stderr is None else p.stderr for p in params], dtype=float)
+        vary = np.array([bool(p.vary) for p in params])
+        pars[name] = (value, stderr, vary)
+    return pars
 
-    if model[prefix + 'sx'].vary and model[prefix + 'sy'].vary \
-            and all(np.isfinite([err_sx, err_sy])):
-        # major axis error
-        ref = wcshelper.pix2sky([xo + sx * np.cos(np.radians(theta)), yo + sy * np.sin(np.radians(theta))])
-        offset = wcshelper.pix2sky(
-            [xo + (sx + err_sx) * np.cos(np.radians(theta)), yo + sy * np.sin(np.radians(theta))])
-        source.err_a = gcd(ref[0], ref[1], offset[0], offset[1]) * 3600
-
-        # minor axis error
-        ref = wcshelper.pix2sky([xo + sx * np.cos(np.radians(theta + 90)), yo + sy * np.sin(np.radians(theta + 90))])
-        offset = wcshelper.pix2sky(
-            [xo + sx * np.cos(np.radians(theta + 90)), yo + (sy + err_sy) * np.sin(np.radians(theta + 90))])
-        source.err_b = gcd(ref[0], ref[1], offset[0], offset[1]) * 3600
-    else:
-        source.err_a = source.err_b = -1
-
-    sqerr = 0
-    sqerr += (source.err_peak_flux / source.peak_flux) ** 2 if source.err_peak_flux > 0 else 0
-    sqerr += (source.err_a / source.a) ** 2 if source.err_a > 0 else 0
-    sqerr += (source.err_b / source.b) ** 2 if source.err_b > 0 else 0
-    if sqerr == 0:
-        source.err_int_flux = -1
-    else:
-        source.err_int_flux = abs(source.int_flux * np.sqrt(sqerr))
 
-    return source
+def _set_bad_errors(source):
+    """
+    Set all the errors for this source to be -1
+    """
+    source.err_peak_flux = source.err_a = source.err_b = source.err_pa = -1
+    source.err_ra = source.err_dec = source.err_int_flux = -1
+    return
 
 
-def new_errors(source, model, wcshelper):
+def _int_flux_sqerr(sources, err_a, err_b):
     """
-    Convert pixel based errors into sky coord errors
-    Uses covariance matrix for ra/dec errors
-    and calculus approach to a/b/pa errors
-    :param source: Source object
+    Sum of the squared fractional errors that contribute to the integrated flux error.
+    """
+    peak = np.array([s.peak_flux for s in sources], dtype=float)
+    err_peak = np.array([np.nan if s.err_peak_flux is None else s.err_peak_flux for s in sources], dtype=float)
+    a = np.array([s.a for s in sources], dtype=float)
+    b = np.array([s.b for s in sources], dtype=float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sqerr = np.where(err_peak > 0, (err_peak / peak) ** 2, 0)
+        sqerr += np.where(err_a > 0, (err_a / a) ** 2, 0)
+        sqerr += np.where(err_b > 0, (err_b / b) ** 2, 0)
+    return sqerr
+
+
+def batch_errors(sources, model, wcshelper):
+    """
+    Convert pixel based errors into sky coord errors for a list of sources.
+    All the pixel positions that are required are converted to sky coords
+    with a single call to the WCS library.
+    :param sources: list of Source objects
+    :param model: lmfit.Parameters that contain all the sources
     :param wcshelper: WCSHelper object
-    :return:
+    :return: the list of sources
     """
-
     # if the source wasn't fit then all errors are -1
-    if source.flags & (flags.NOTFIT | flags.FITERR):
-        source.err_peak_flux = source.err_a = source.err_b = source.err_pa = -1
-        source.err_ra = source.err_dec = source.err_int_flux = -1
-        return source
-    # copy the errors/values from the model
-    prefix = "c{0}_".format(source.source)
-    err_amp = model[prefix + 'amp'].stderr
-    xo, yo = model[prefix + 'xo'].value, model[prefix + 'yo'].value
-    err_xo = model[prefix + 'xo'].stderr
-    err_yo = model[prefix + 'yo'].stderr
-
-    sx, sy = model[prefix + 'sx'].value, model[prefix + 'sy'].value
-    err_sx = model[prefix + 'sx'].stderr
-    err_sy = model[prefix + 'sy'].stderr
+    good = []
+    for src in sources:
+        if src.flags & (flags.NOTFIT | flags.FITERR):
+            _set_bad_errors(src)
+        else:
+            good.append(src)
+    if len(good) == 0:
+        return sources
+
+    pars = _gather_components(good, model)
+    amp, err_amp, _ = pars['amp']
+    xo, err_xo, vary_xo = pars['xo']
+    yo, err_yo, vary_yo = pars['yo']
+    sx, err_sx, vary_sx = pars['sx']
+    sy, err_sy, vary_sy = pars['sy']
+    theta, err_theta, vary_theta = pars['theta']
+    log.debug("Pix errs: {0}".format(zip(err_xo, err_yo, err_sx, err_sy, err_theta)))
+
+    t = np.radians(theta)
+    t_err = np.radians(theta + err_theta)
+    t_perp = np.radians(theta + 90)
+    # the positions of interest are:
+    # 0 - the reference position
+    # 1 - the reference position offset by the position errors
+    # 2/3 - the end of the major axis at theta and theta+err_theta
+    # 4 - the end of the major axis extended by err_sx
+    # 5/6 - the end of the minor axis, and extended by err_sy
+    x = np.array([xo, xo + err_xo,
+                  xo + sx * np.cos(t), xo + sx * np.cos(t_err),
+                  xo + (sx + err_sx) * np.cos(t),
+                  xo + sx * np.cos(t_perp), xo + sx * np.cos(t_perp)])
+    y = np.array([yo, yo + err_yo,
+                  yo + sy * np.sin(t), yo + sy * np.sin(t_err),
+                  yo + sy * np.sin(t),
+                  yo + sy * np.sin(t_perp), yo + (sy + err_sy) * np.sin(t_perp)])
+    ra, dec = wcshelper.pix2sky_many(x, y)
+
+    with np.errstate(invalid='ignore'):
+        # position errors
+        pos_ok = vary_xo & vary_yo & np.isfinite(err_xo) & np.isfinite(err_yo)
+        err_ra = np.where(pos_ok, gcd(ra[0], dec[0], ra[1], dec[0]), -1)
+        err_dec = np.where(pos_ok, gcd(ra[0], dec[0], ra[0], dec[1]), -1)
 
-    theta = model[prefix + 'theta'].value
-    err_theta = model[prefix + 'theta'].stderr
+        # pa error
+        pa_ok = vary_theta & np.isfinite(err_theta)
+        err_pa = np.where(pa_ok, abs(bear(ra[0], dec[0], ra[2], dec[2]) - bear(ra[0], dec[0], ra[3], dec[3])), -1)
+
+        # major/minor axis errors
+        size_ok = vary_sx & vary_sy & np.isfinite(err_sx) & np.isfinite(err_sy)
+        err_a = np.where(size_ok, gcd(ra[2], dec[2], ra[4], dec[4]) * 3600, -1)
+        err_b = np.where(size_ok, gcd(ra[5], dec[5], ra[6], dec[6]) * 3600, -1)
+
+    for i, src in enumerate(good):
+        src.err_peak_flux = model["c{0}_amp".format(src.source)].stderr
+        src.err_ra, src.err_dec, src.err_pa = err_ra[i], err_dec[i], err_pa[i]
+        src.err_a, src.err_b = err_a[i], err_b[i]
+
+    sqerr = _int_flux_sqerr(good, err_a, err_b)
+    for i, src in enumerate(good):
+        # check to see if the reference position has a valid WCS coordinate
+        # It is possible for this to fail, even if the ra/dec conversion works elsewhere
+        if not (np.isfinite(ra[0][i]) and np.isfinite(dec[0][i])):
+            src.flags |= flags.WCSERR
+            _set_bad_errors(src)
+            continue
+        if sqerr[i] == 0:
+            src.err_int_flux = -1
+        else:
+            src.err_int_flux = abs(src.int_flux * np.sqrt(sqerr[i]))
+    return sources
 
-    # the peak flux error doesn't need to be converted, just copied
-    source.err_peak_flux = err_amp
 
-    pix_errs = [err_xo, err_yo, err_sx, err_sy, err_theta]
+def batch_new_errors(sources, model, wcshelper):
+    """
+    Convert pixel based errors into sky coord errors for a list of sources.
+    Uses covariance matrix for ra/dec errors
+    and calculus approach to a/b/pa errors.
+    All the pixel positions that are required are converted to sky coords
+    with a single call to the WCS library.
+    :param sources: list of Source objects
+    :param model: lmfit.Parameters that contain all the sources
+    :param wcshelper: WCSHelper object
+    :return: the list of sources
+    """
+    # if the source wasn't fit then all errors are -1
+    good = []
+    for src in sources:
+        if src.flags & (flags.NOTFIT | flags.FITERR):
+            _set_bad_errors(src)
+        else:
+            good.append(src)
+    if len(good) == 0:
+        return sources
+
+    pars = _gather_components(good, model)
+    amp, err_amp, _ = pars['amp']
+    xo, err_xo, vary_xo = pars['xo']
+    yo, err_yo, vary_yo = pars['yo']
+    sx, err_sx, vary_sx = pars['sx']
+    sy, err_sy, vary_sy = pars['sy']
+    theta, err_theta, vary_theta = pars['theta']
 
     # check for inf/nan errors -> these sources have poor fits.
-    if not all(a is not None and np.isfinite(a) for a in pix_errs):
-        source.flags |= flags.FITERR
-        source.err_peak_flux = source.err_a = source.err_b = source.err_pa = -1
-        source.err_ra = source.err_dec = source.err_int_flux = -1
-        return source
-
-    # calculate the reference coordinate
-    ref = wcshelper.pix2sky([xo, yo])
-    # check to see if the reference position has a valid WCS coordinate
-    # It is possible for this to fail, even if the ra/dec conversion works elsewhere
-    if not all(np.isfinite(ref)):
-        source.flags |= flags.WCSERR
-        source.err_peak_flux = source.err_a = source.err_b = source.err_pa = -1
-        source.err_ra = source.err_dec = source.err_int_flux = -1
-        return source
-
-    # calculate position errors by transforming the error ellipse
-    if model[prefix + 'xo'].vary and model[prefix + 'yo'].vary:
-        # determine the error ellipse from the Jacobian
+    finite = np.all(np.isfinite([err_xo, err_yo, err_sx, err_sy, err_theta]), axis=0)
+
+    # the error ellipse for the position is determined from the covariance matrix
+    pos_ok = vary_xo & vary_yo
+    a = b = pa = np.zeros(len(good))
+    if np.any(pos_ok & finite):
         mat = model.covar[1:3, 1:3]
-        if not(np.all(np.isfinite(mat))):
-            source.err_ra = source.err_dec = -1
-        else:
+        if np.all(np.isfinite(mat)):
             (a, b), e = np.linalg.eig(mat)
             pa = np.degrees(np.arctan2(*e[0]))
-            # transform this ellipse into sky coordinates
-            ra, dec, major, minor, pa = wcshelper.pix2sky_ellipse([xo, yo], a, b, pa)
-
-            # now determine the radius of the ellipse along the ra/dec directions.
-            source.err_ra = major*minor / np.hypot(major*np.sin(np.radians(pa)), minor*np.cos(np.radians(pa)))
-            source.err_dec = major*minor / np.hypot(major*np.cos(np.radians(pa)), minor*np.sin(np.radians(pa)))
-    else:
-        source.err_ra = source.err_dec = -1
+        else:
+            pos_ok[:] = False
+
+    t = np.radians(theta)
+    t_one = np.radians(theta + 1)
+    t_perp = np.radians(theta + 90)
+    # the positions of interest are:
+    # 0 - the reference position
+    # 1/2 - the ends of the position error ellipse axes
+    # 3/4 - the end of the major axis at theta and theta + 1 degree
+    # 5 - the end of the major axis extended by 0.1 pixels
+    # 6/7 - the end of the minor axis, and extended by 0.1 pixels
+    x = np.array([xo,
+                  xo + a * np.cos(np.radians(pa)), xo + b * np.cos(np.radians(pa - 90)),
+                  xo + sx * np.cos(t), xo + sx * np.cos(t_one),
+                  xo + (sx + 0.1) * np.cos(t),
+                  xo + sx * np.cos(t_perp), xo + sx * np.cos(t_perp)])
+    y = np.array([yo,
+                  yo + a * np.sin(np.radians(pa)), yo + b * np.sin(np.radians(pa - 90)),
+                  yo + sy * np.sin(t), yo + sy * np.sin(t_one),
+                  yo + sy * np.sin(t),
+                  yo + sy * np.sin(t_perp), yo + (sy + 0.1) * np.sin(t_perp)])
+    ra, dec = wcshelper.pix2sky_many(x, y)
+
+    with np.errstate(invalid='ignore'):
+        # transform the error ellipse into sky coordinates and
+        # determine the radius of the ellipse along the ra/dec directions.
+        major, minor, pa = _ellipse_on_sky(ra[0], dec[0], ra[1], dec[1], ra[2], dec[2])
+        err_ra = major * minor / np.hypot(major * np.sin(np.radians(pa)), minor * np.cos(np.radians(pa)))
+        err_dec = major * minor / np.hypot(major * np.cos(np.radians(pa)), minor * np.sin(np.radians(pa)))
+        err_ra = np.where(pos_ok, err_ra, -1)
+        err_dec = np.where(pos_ok, err_dec, -1)
+
+        # pa error, scale the initial theta error by the change in bearing for a 1 degree change
+        err_pa = abs(bear(ra[0], dec[0], ra[3], dec[3]) - bear(ra[0], dec[0], ra[4], dec[4])) * err_theta
+        err_pa = np.where(vary_theta, err_pa, -1)
+
+        # major/minor axis errors, from the change in length for a 0.1 pixel change
+        size_ok = vary_sx & vary_sy
+        err_a = np.where(size_ok, gcd(ra[3], dec[3], ra[5], dec[5]) / 0.1 * err_sx * 3600, -1)
+        err_b = np.where(size_ok, gcd(ra[6], dec[6], ra[7], dec[7]) / 0.1 * err_sy * 3600, -1)
+
+    for i, src in enumerate(good):
+        # the peak flux error doesn't need to be converted, just copied
+        src.err_peak_flux = model["c{0}_amp".format(src.source)].stderr
+        src.err_ra, src.err_dec, src.err_pa = err_ra[i], err_dec[i], err_pa[i]
+        src.err_a, src.err_b = err_a[i], err_b[i]
+
+    sqerr = _int_flux_sqerr(good, err_a, err_b)
+    for i, src in enumerate(good):
+        if not finite[i]:
+            src.flags |= flags.FITERR
+            _set_bad_errors(src)
+            continue
+        # check to see if the reference position has a valid WCS coordinate
+        # It is possible for this to fail, even if the ra/dec conversion works elsewhere
+        if not (np.isfinite(ra[0][i]) and np.isfinite(dec[0][i])):
+            src.flags |= flags.WCSERR
+            _set_bad_errors(src)
+            continue
+        src.err_int_flux = abs(src.int_flux * np.sqrt(sqerr[i]))
+    return sources
 
-    if model[prefix + 'theta'].vary:
-        # pa error
-        off1 = wcshelper.pix2sky([xo + sx * np.cos(np.radians(theta)), yo + sy * np.sin(np.radians(theta))])
-        # offset by 1 degree
-        off2 = wcshelper.pix2sky(
-            [xo + sx * np.cos(np.radians(theta + 1)), yo + sy * np.sin(np.radians(theta + 1))])
-        # scale the initial theta error by this amount
-        source.err_pa = abs(bear(ref[0], ref[1], off1[0], off1[1]) - bear(ref[0], ref[1], off2[0], off2[1])) * err_theta
-    else:
-        source.err_pa = -1
 
-    if model[prefix + 'sx'].vary and model[prefix + 'sy'].vary:
-        # major axis error
-        ref = wcshelper.pix2sky([xo + sx * np.cos(np.radians(theta)), yo + sy * np.sin(np.radians(theta))])
-        # offset by 0.1 pixels
-        offset = wcshelper.pix2sky(
-            [xo + (sx + 0.1) * np.cos(np.radians(theta)), yo + sy * np.sin(np.radians(theta))])
-        source.err_a = gcd(ref[0], ref[1], offset[0], offset[1])/0.1 * err_sx * 3600
-
-        # minor axis error
-        ref = wcshelper.pix2sky([xo + sx * np.cos(np.radians(theta + 90)), yo + sy * np.sin(np.radians(theta + 90))])
-        # offset by 0.1 pixels
-        offset = wcshelper.pix2sky(
-            [xo + sx * np.cos(np.radians(theta + 90)), yo + (sy + 0.1) * np.sin(np.radians(theta + 90))])
-        source.err_b = gcd(ref[0], ref[1], offset[0], offset[1])/0.1*err_sy * 3600
-    else:
-        source.err_a = source.err_b = -1
+def errors(source, model, wcshelper):
+    """
+    Convert pixel based errors into sky coord errors
+    :param source: Source object
+    :param wcshelper: WCSHelper object
+    :return:
+    """
+    return batch_errors([source], model, wcshelper)[0]
 
-    sqerr = 0
-    sqerr += (source.err_peak_flux / source.peak_flux) ** 2 if source.err_peak_flux > 0 else 0
-    sqerr += (source.err_a / source.a) ** 2 if source.err_a > 0 else 0
-    sqerr += (source.err_b / source.b) ** 2 if source.err_b > 0 else 0
-    source.err_int_flux = abs(source.int_flux * np.sqrt(sqerr))
 
-    return source
+def new_errors(source, model, wcshelper):
+    """
+    Convert pixel based errors into sky coord errors
+    Uses covariance matrix for ra/dec errors
+    and calculus approach to a/b/pa errors
+    :param source: Source object
+    :param wcshelper: WCSHelper object
+    :return:
+    """
+    return batch_new_errors([source], model, wcshelper)[0]
 
 
 def ntwodgaussian_lmfit(params):
@@ -950,7 +1155,7 @@ def do_lmfit(data, params, B=None, errs=None, dojac=True):
         if B is None:
             return model - data[mask]
         else:
-            return (model - data[mask]).dot(B)
+            return whiten(model - data[mask], B)
 
     if dojac:
         result = lmfit.minimize(residual, params, kws={'x': mask[0], 'y': mask[1], 'B': B, 'errs': errs}, Dfun=lmfit_jacobian)
@@ -958,7 +1163,9 @@ def do_lmfit(data, params, B=None, errs=None, dojac=True):
         result = lmfit.minimize(residual, params, kws={'x': mask[0], 'y': mask[1], 'B': B, 'errs': errs})
 
     # Remake the residual so that it is once again (model - data)
-    if B is not None:
+    if isinstance(B, SparseBmatrix):
+        result.residual = ntwodgaussian_lmfit(result.params)(*mask) - data[mask]
+    elif B is not None:
         result.residual = result.residual.dot(inv(B))
     return result, params
 
@@ -977,6 +1184,10 @@ def covar_errors(params, data, errs, B, C=None):
 
     mask = np.where(np.isfinite(data))
 
+    # a sparse C can't be inverted, but the sparse B matrix can be used instead
+    if scipy.sparse.issparse(C):
+        C = None
+
     # calculate the proper parameter errors and copy them across.
     if C is not None:
         try:
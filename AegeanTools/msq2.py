@@ -8,6 +8,7 @@ by Paul Hancock
 May 2014
 """
 
+import bisect
 from copy import copy
 import logging
 import numpy as np
@@ -28,6 +29,7 @@ class MarchingSquares():
         self.next = self.NOWHERE
         self.data = np.nan_to_num(data)
         self.xsize, self.ysize = data.shape
+        self.codes = None
         self.perimeter = self.do_march()
         return
 
@@ -47,11 +49,29 @@ class MarchingSquares():
         """
         Find the first location in our array that is not empty
         """
-        for i, row in enumerate(self.data):
-            for j, col in enumerate(row):
-                if self.data[i, j] != 0:  # or not np.isfinite(self.data[i,j]):
-                    return i, j
-        return None
+        nonzero = np.flatnonzero(self.data)
+        if len(nonzero) == 0:
+            return None
+        return divmod(int(nonzero[0]), self.data.shape[1])
+
+    def make_codes(self, xmin=0, xmax=None):
+        """
+        Compute the state of every 2x2 neighbourhood of pixels in one pass.
+        The state at (x,y) describes pixels (x-1,y-1), (x,y-1), (x-1,y), (x,y) as bits 1, 2, 4, 8
+        (as per step), and is stored for 0<=x<=xsize, 0<=y<=ysize.
+        :param xmin, xmax: only (re)compute the states for xmin<=x<=xmax, requires that self.codes exists
+        :return None:
+        """
+        if xmax is None or self.codes is None:
+            xmin, xmax = 0, self.xsize
+            self.codes = np.empty((self.xsize + 1, self.ysize + 1), dtype=np.uint8)
+        # pixels xmin-1 to xmax, padded with a blank border
+        solid = np.zeros((xmax - xmin + 2, self.ysize + 2), dtype=np.uint8)
+        lo, hi = max(xmin - 1, 0), min(xmax + 1, self.xsize)
+        block = self.data[lo:hi]
+        solid[lo - xmin + 1:hi - xmin + 1, 1:-1] = (block != 0) & np.isfinite(block)
+        self.codes[xmin:xmax + 1] = solid[:-1, :-1] | (solid[1:, :-1] << 1) | (solid[:-1, 1:] << 2) | (solid[1:, 1:] << 3)
+        return
 
     def step(self, x, y):
         """
@@ -111,6 +131,11 @@ class MarchingSquares():
 
     def walk_perimeter(self, startx, starty):
         """
+        Walk around the perimeter of the object that has (startx, starty) as its top left corner.
+        The 2x2 states are looked up from self.codes rather than being computed at each step.
+        :param startx:
+        :param starty:
+        :return: a list of (x,y) points
         """
         # checks
         startx = max(startx, 0)
@@ -118,34 +143,39 @@ class MarchingSquares():
         starty = max(starty, 0)
         starty = min(starty, self.ysize)
 
-        points = []
-
-        x, y = startx, starty
+        if self.codes is None:
+            self.make_codes()
+        # work with a flat index into the codes: moving in x is a step of ncols, in y a step of 1
+        ncols = self.ysize + 1
+        code = self.codes.item
+        up, down, left, right = self.UP, self.DOWN, self.LEFT, self.RIGHT
+        moves = {up: -1, down: 1, left: -ncols, right: ncols}
+        # the direction to move for each state, except 6 and 9 which depend on the previous move
+        table = [self.NOWHERE, up, right, right, left, up, None, right,
+                 down, None, down, down, left, up, left, self.NOWHERE]
 
+        points = []
+        start = startx * ncols + starty
+        idx = start
+        nxt = self.next
         while True:
-            self.step(x, y)
-            if 0 <= x <= self.xsize and 0 <= y <= self.ysize:
-                points.append((x, y))
-            if self.next == self.UP:
-                y -= 1
-            elif self.next == self.LEFT:
-                x -= 1
-            elif self.next == self.DOWN:
-                y += 1
-            elif self.next == self.RIGHT:
-                x += 1
-            elif self.next == self.NOWHERE:
-                break
-            else:
-                #not sure what to do here
-                logging.warn("Failed to determine next step")
+            prev = nxt
+            state = code(idx)
+            nxt = table[state]
+            if nxt is None:
+                if state == 6:
+                    nxt = left if prev == up else right
+                else:
+                    nxt = up if prev == right else down
+            # the perimeter of solid pixels never leaves 0<=x<=xsize, 0<=y<=ysize
+            points.append(divmod(idx, ncols))
+            if nxt == self.NOWHERE:
                 break
-            #stop when we return to the starting location
-            if x == startx and y == starty:
+            idx += moves[nxt]
+            # stop when we return to the starting location
+            if idx == start:
                 break
-            #if i>max_tries:
-            #	break
-            #i+=1
+        self.prev, self.next = prev, nxt
         return points
 
     def do_march(self):
@@ -165,6 +195,12 @@ class MarchingSquares():
         # Method:
         # scan around the perimeter filling 'up' from each pixel
         # stopping when we reach the other boundary
+        # the columns of the perimeter points on each row, so that the next boundary can be found by bisection
+        columns = {}
+        for p in set(perimeter):
+            columns.setdefault(p[0], []).append(p[1])
+        for c in columns.values():
+            c.sort()
         for p in perimeter:
             # if we are on the edge of the data then there is nothing to fill
             if p[0] >= self.data.shape[0] or p[1] >= self.data.shape[1]:
@@ -173,18 +209,16 @@ class MarchingSquares():
             if self.data[p] == 0:
                 continue
 
-            # blank this pixel
-            self.data[p] = 0
-
-            # blank until we reach the other perimeter
-            for i in xrange(p[1]+1, self.data.shape[1]):
-                q = p[0], i
-                # stop when we reach another part of the perimeter
-                if q in perimeter:
-                    break
-                # fill everything in between, even inclusions
-                self.data[q] = 0
-
+            # blank this pixel and everything up to the next part of the perimeter on this row, even inclusions
+            row = columns[p[0]]
+            k = bisect.bisect_right(row, p[1])
+            end = row[k] if k < len(row) else self.data.shape[1]
+            self.data[p[0], p[1]:end] = 0
+        # update the 2x2 states for the rows that have been blanked
+        if self.codes is not None and columns:
+            rows = [x for x in columns if x < self.xsize]
+            if rows:
+                self.make_codes(min(rows), max(rows) + 1)
         return
 
     def do_march_all(self):
@@ -193,6 +227,7 @@ class MarchingSquares():
         """
         # copy the data since we are going to be modifying it
         data_copy = copy(self.data)
+        codes_copy = copy(self.codes)
         
         # iterate through finding an island, creating a perimeter,
         # and then blanking the island
@@ -205,8 +240,9 @@ class MarchingSquares():
             self._blank_within(perim)
             p = self.find_start_point()
 
-        # restore the data 
+        # restore the data
         self.data = data_copy
+        self.codes = codes_copy
         return perimeters
                 
 
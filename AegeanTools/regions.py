@@ -4,11 +4,99 @@ import os
 import datetime
 import healpy as hp #dev on 1.8.1
 import numpy as np #dev on 1.8.1
-from astropy.coordinates import SkyCoord
-import astropy.units as u
 from astropy.io import fits
 
 
+def merge_ranges(starts, stops):
+    """
+    Combine a list of (possibly overlapping or adjacent) pixel ranges into a sorted list of disjoint ranges.
+    :param starts: array of the first pixel in each range
+    :param stops: array of one past the last pixel in each range
+    :return: an (N,2) int64 array of [start, stop) ranges
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    stops = np.asarray(stops, dtype=np.int64)
+    keep = stops > starts
+    starts, stops = starts[keep], stops[keep]
+    if len(starts) == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    order = np.argsort(starts, kind='mergesort')
+    starts = starts[order]
+    stops = np.maximum.accumulate(stops[order])
+    # a new range begins wherever there is a gap after the preceding ranges
+    gaps = starts[1:] > stops[:-1]
+    first = np.concatenate(([True], gaps))
+    last = np.concatenate((gaps, [True]))
+    return np.column_stack((starts[first], stops[last]))
+
+
+def ranges_within(ranges, pix):
+    """
+    Determine which pixels are within a set of ranges.
+    :param ranges: an (N,2) array of sorted disjoint [start, stop) ranges
+    :param pix: array of pixels
+    :return: boolean array, True if pix is within one of the ranges
+    """
+    return np.searchsorted(ranges.ravel(), pix, side='right') % 2 == 1
+
+
+def ranges_op(a, b, op):
+    """
+    Combine two sets of ranges with a binary operation, by comparing them at each of their boundaries.
+    :param a: an (N,2) array of sorted disjoint [start, stop) ranges
+    :param b: as for a
+    :param op: a function that takes two boolean arrays (within a, within b) and returns a boolean array,
+               eg numpy.logical_and for an intersection
+    :return: an (N,2) array of sorted disjoint [start, stop) ranges
+    """
+    points = np.union1d(a.ravel(), b.ravel())
+    inside = op(ranges_within(a, points), ranges_within(b, points))
+    # inside[i] is true if all pixels [points[i], points[i+1]) are included
+    change = np.diff(np.concatenate(([False], inside)).astype(np.int8))
+    return np.column_stack((points[change == 1], points[change == -1]))
+
+
+def _sexagesimal(values, precision=2):
+    """
+    Format angles as sexagesimal strings, in the same way as astropy's Angle.to_string(sep=':').
+    :param values: array of angles
+    :param precision: number of decimal places for the seconds
+    :return: list of strings
+    """
+    sign = np.copysign(1.0, values)
+    fd, d = np.modf(np.abs(values))
+    fm, m = np.modf(fd * 60.)
+    s = fm * 60.
+    # carry the rounding of the seconds/minutes
+    carry = s >= 60.0 - 10.0 ** -precision
+    s[carry] = 0.0
+    m[carry] += 1.0
+    carry = m >= 60.0
+    m[carry] = 0.0
+    d[carry] += 1.0
+    d = np.copysign(d, sign)
+    out = []
+    for dd, mm, ss in zip(d.tolist(), m.astype(int).tolist(), s.tolist()):
+        ss = '{0:.{1}f}'.format(ss, precision)
+        if len(ss) == 1 or ss[1] == '.':
+            ss = '0' + ss
+        out.append('{0:.0f}:{1:02d}:{2}'.format(dd, mm, ss))
+    return out
+
+
+def _format_coords(ra, dec, degrees=False):
+    """
+    Format ra/dec pairs for a ds9 region file.
+    :param ra: array of ra in degrees
+    :param dec: array of dec in degrees
+    :param degrees: If True write decimal degrees, otherwise sexagesimal (hours for ra)
+    :return: list of 'ra,dec' strings
+    """
+    if degrees:
+        return ['{0:.6f},{1:.6f}'.format(r, d) for r, d in zip(ra.tolist(), dec.tolist())]
+    return [r + ',' + d for r, d in zip(_sexagesimal(ra / 15.), _sexagesimal(dec))]
+
+
 class Region(object):
     """
     A Region object represents a footprint on the sky. This is done in a way similar to a MOC.
@@ -17,20 +105,46 @@ class Region(object):
 
     def __init__(self, maxdepth=11):
         self.maxdepth = maxdepth
-        self.pixeldict = dict((i, set()) for i in xrange(1, maxdepth+1))
+        self._pixeldict = dict((i, set()) for i in xrange(1, maxdepth+1))
         self.demoted = set()
+        self._ranges = None
         return
 
+    def __setstate__(self, state):
+        # regions that were pickled before the pixels could be built lazily have a pixeldict attribute
+        if 'pixeldict' in state:
+            state['_pixeldict'] = state.pop('pixeldict')
+        state.setdefault('_ranges', None)
+        self.__dict__.update(state)
+        return
+
+    @property
+    def pixeldict(self):
+        """
+        A dictionary of {depth: set(pixels)} that describes this region.
+        If the region was created from ranges of pixels (eg by from_fits) then the sets are built on first access.
+        """
+        if self._pixeldict is None:
+            self._pixeldict = self._ranges_to_pixels(self._ranges)
+        return self._pixeldict
+
+    @pixeldict.setter
+    def pixeldict(self, value):
+        self._pixeldict = value
+        self._ranges = None
+
     def __repr__(self):
         return "Region with maximum depth {0}, and total area {1:5.2g} deg^2".format(self.maxdepth, self.get_area())
 
-    def add_circles(self, ra_cen, dec_cen, radius, depth=None):
+    def add_circles(self, ra_cen, dec_cen, radius, depth=None, renorm=True):
         """
         Add one or more circles to this region
         :param ra_cen: ra or list of ras for circle centers
         :param dec_cen: dec or list of decs for circle centers
         :param radius: radius or list of radii for circles
         :param depth: The depth at which we wish to represent the circle (forced to be <=maxdepth)
+        :param renorm: If False, the region is not normalised. This allows many shapes to be added
+                       with a single call to _renorm at the end.
         :return: None
         """
         if depth is None or depth > self.maxdepth:
@@ -42,17 +156,19 @@ class Region(object):
             sky = [[ra_cen, dec_cen]]
             rad = [radius]
         vectors = self.sky2vec(sky)
-        for vec, r in zip(vectors, rad):
-            pix = hp.query_disc(2**depth, vec, r, inclusive=True, nest=True)
-            self.add_pixels(pix, depth)
-        self._renorm()
+        pix = [hp.query_disc(2**depth, vec, r, inclusive=True, nest=True) for vec, r in zip(vectors, rad)]
+        if len(pix) > 0:
+            self.add_pixels(np.concatenate(pix), depth)
+        if renorm:
+            self._renorm()
         return
 
-    def add_poly(self, positions, depth=None):
+    def add_poly(self, positions, depth=None, renorm=True):
         """
         Add a single polygon to this region
         :param positions: list of [ (ra,dec), ... ] positions that form the polygon
         :param depth: The depth at which we wish to represent the circle (forced to be <=maxdepth
+        :param renorm: If False, the region is not normalised (see add_circles)
         :return: None
         """
         assert len(positions) >= 3, "A minimum of three coordinate pairs are required"
@@ -64,13 +180,17 @@ class Region(object):
         sky = self.radec2sky(ras, decs)
         pix = hp.query_polygon(2**depth, self.sky2vec(sky), inclusive=True, nest=True)
         self.add_pixels(pix, depth)
-        self._renorm()
+        if renorm:
+            self._renorm()
         return
 
     def add_pixels(self, pix, depth):
         if depth not in self.pixeldict:
             self.pixeldict[depth] = set()
-        self.pixeldict[depth].update(set(pix))
+        if isinstance(pix, np.ndarray):
+            pix = pix.tolist()
+        self.pixeldict[depth].update(pix)
+        self._ranges = None
         pass
 
     def get_area(self, degrees=True):
@@ -86,6 +206,68 @@ class Region(object):
         self._demote_all()
         return self.demoted
 
+    def get_ranges(self):
+        """
+        The region as a sorted array of disjoint ranges of pixels at maxdepth.
+        The ranges are computed from the pixels at each depth without demoting them,
+        and are cached until the region is changed.
+        :return: an (N,2) int64 array of [start, stop) ranges
+        """
+        if self._ranges is None:
+            starts, stops = [], []
+            for d in xrange(1, self.maxdepth+1):
+                pix = np.fromiter(self.pixeldict[d], dtype=np.int64, count=len(self.pixeldict[d]))
+                shift = 2 * (self.maxdepth - d)
+                starts.append(pix << shift)
+                stops.append((pix + 1) << shift)
+            self._ranges = merge_ranges(np.concatenate(starts), np.concatenate(stops))
+        return self._ranges
+
+    def _set_ranges(self, ranges):
+        """
+        Replace the pixels of this region with those described by ranges of pixels at maxdepth.
+        The pixel sets are not built until pixeldict is accessed.
+        :param ranges: an (N,2) array of sorted disjoint [start, stop) ranges
+        :return: None
+        """
+        ranges = np.asarray(ranges, dtype=np.int64).reshape(-1, 2)
+        self._ranges = merge_ranges(ranges[:, 0], ranges[:, 1])
+        self._pixeldict = None
+        self.demoted = set()
+        return
+
+    def _ranges_to_pixels(self, ranges):
+        """
+        Convert ranges of pixels at maxdepth into a pixel dictionary.
+        The pixels are stored at the lowest depth possible (but not below depth 2), as per _renorm.
+        :param ranges: an (N,2) array of sorted disjoint [start, stop) ranges
+        :return: a dictionary of {depth: set(pixels)}
+        """
+        starts, stops = ranges[:, 0], ranges[:, 1]
+        pixeldict = dict((d, set()) for d in xrange(1, self.maxdepth+1))
+        mindepth = min(2, self.maxdepth)
+        for d in xrange(mindepth, self.maxdepth+1):
+            shift = 2 * (self.maxdepth - d)
+            # the cells at this depth that are completely within each range
+            lo = (starts + (1 << shift) - 1) >> shift
+            hi = stops >> shift
+            if d > mindepth:
+                # cells whose parent is also completely within the range are stored at the parent depth
+                plo = (starts + (1 << (shift + 2)) - 1) >> (shift + 2)
+                phi = stops >> (shift + 2)
+                has_parent = plo < phi
+                seg_lo = np.concatenate((lo, np.where(has_parent, 4 * phi, hi)))
+                seg_hi = np.concatenate((np.where(has_parent, 4 * plo, hi), hi))
+            else:
+                seg_lo, seg_hi = lo, hi
+            lengths = np.maximum(seg_hi - seg_lo, 0)
+            total = lengths.sum()
+            if total == 0:
+                continue
+            offsets = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+            pixeldict[d] = set((np.repeat(seg_lo, lengths) + offsets).tolist())
+        return pixeldict
+
     def _demote_all(self):
         """
         Represent this region as pixels at maxdepth only
@@ -93,11 +275,17 @@ class Region(object):
         # only do the calculations if the demoted list is empty
         if len(self.demoted) == 0:
             pd = self.pixeldict
+            children = []
             for d in xrange(1, self.maxdepth):
-                for p in pd[d]:
-                    pd[d+1].update(set((4*p, 4*p+1, 4*p+2, 4*p+3)))
+                pix = np.fromiter(pd[d], dtype=np.int64, count=len(pd[d]))
+                if len(pix) > 0:
+                    # every pixel at maxdepth that is within these pixels
+                    shift = 2 * (self.maxdepth - d)
+                    children.append(((pix << shift)[:, np.newaxis] + np.arange(1 << shift)).ravel())
                 pd[d] = set()  # clear the pixels from this level
-            self.demoted = pd[d+1]
+            if len(children) > 0:
+                pd[self.maxdepth].update(np.concatenate(children).tolist())
+            self.demoted = pd[self.maxdepth]
         return
 
     def _renorm(self):
@@ -105,56 +293,67 @@ class Region(object):
         Remake the pixel dictionary, merging groups of pixels at level N into a single pixel
         at level N-1
         """
-        self.demoted = set()
-        # convert all to lowest level
-        self._demote_all()
-        # now promote as needed
-        for d in xrange(self.maxdepth, 2, -1):
-            plist = self.pixeldict[d].copy()
-            for p in plist:
-                if p % 4 == 0:
-                    nset = set((p, p+1, p+2, p+3))
-                    if p+1 in plist and p+2 in plist and p+3 in plist:
-                        # remove the four pixels from this level
-                        self.pixeldict[d].difference_update(nset)
-                        # add a new pixel to the next level up
-                        self.pixeldict[d-1].add(p/4)
-        self.demoted = set()
+        # the ranges of pixels at maxdepth account for pixels that overlap or are at different depths
+        self._set_ranges(self.get_ranges())
         return
 
-    #@profile
+    # the number of positions that sky_within converts to pixels at a time
+    chunksize = 2**20
+
     def sky_within(self, ra, dec, degin=False):
         """
         Test whether a sky position is within this region
+        Large arrays of positions are processed in chunks to limit the memory used.
         :param ra: RA in radians
         :param dec: Dec in radians
         :param degin: True if the input parameters are in degrees instead of radians
-        :return: True if RA/Dec is within this region
-        """
-        sky = self.radec2sky(ra, dec)
-
-        if degin:
-            sky = np.radians(sky)
-
-        theta_phi = self.sky2ang(sky)
-        # cut out any entries that have nan for theta or phi
-        mask = np.logical_and.reduce(np.isfinite(theta_phi), axis=0)
-        theta_phi = theta_phi[:, mask]
-        # need to check shape as the above can give 'empty' arrays of shape (22,0)
-        if theta_phi.shape[1] < 1:
-            return False
-
-        theta, phi = theta_phi.transpose()
-        pix = hp.ang2pix(2**self.maxdepth, theta, phi, nest=True)
-        pixelset = self.get_demoted()
-        result = np.in1d(pix, list(pixelset))
+        :return: An array that is True if RA/Dec is within this region. Positions that are not finite are False.
+        """
+        ra = np.ravel(np.asarray(ra, dtype=np.float64))
+        dec = np.ravel(np.asarray(dec, dtype=np.float64))
+        result = np.zeros(len(ra), dtype=bool)
+        ranges = self.get_ranges()
+        nside = 2**self.maxdepth
+        for lo in xrange(0, len(ra), self.chunksize):
+            r = ra[lo:lo + self.chunksize]
+            d = dec[lo:lo + self.chunksize]
+            if degin:
+                r = np.radians(r)
+                d = np.radians(d)
+            good = np.isfinite(r) & np.isfinite(d)
+            if not np.all(good):
+                r, d = r[good], d[good]
+            # theta/phi as per sky2ang
+            pix = hp.ang2pix(nside, np.pi/2 - d, r, nest=True)
+            result[lo:lo + self.chunksize][good] = ranges_within(ranges, pix)
         return result
 
+    def _other_ranges(self, other, inner=False):
+        """
+        Get the ranges of pixels for another region, expressed at the maxdepth of this region.
+        :param other: A Region
+        :param inner: If the other region is deeper than this one then only include pixels that are completely
+                      covered by the other region. Default = False = include pixels that are partly covered.
+        :return: an (N,2) array of sorted disjoint [start, stop) ranges
+        """
+        ranges = other.get_ranges()
+        shift = 2 * abs(self.maxdepth - other.maxdepth)
+        if self.maxdepth >= other.maxdepth:
+            return ranges << shift
+        if inner:
+            return merge_ranges((ranges[:, 0] + (1 << shift) - 1) >> shift, ranges[:, 1] >> shift)
+        return merge_ranges(ranges[:, 0] >> shift, (ranges[:, 1] + (1 << shift) - 1) >> shift)
+
     def union(self, other, renorm=True):
         """
         Add another Region by performing union on their pixlists
         :param other: A Region
+        :param renorm: If False the pixels are added but the region is not normalised
         """
+        if renorm:
+            # include any pixel of ours that is partly covered by the other region
+            self._set_ranges(ranges_op(self.get_ranges(), self._other_ranges(other), np.logical_or))
+            return
         # merge the pixels that are common to both
         for d in xrange(1, min(self.maxdepth, other.maxdepth)+1):
             self.add_pixels(other.pixeldict[d], d)
@@ -166,76 +365,90 @@ class Region(object):
                     # promote this pixel to self.maxdepth
                     pp = p/4**(d-self.maxdepth)
                     self.pixeldict[self.maxdepth].add(pp)
-        if renorm:
-            self._renorm()
+        self._ranges = None
         return
 
     def without(self, other):
         """
         Remove the overlap between this region and the other region
+        If the other region has a greater maxdepth then pixels that are only partly covered are kept.
         :param other: Another region
         :return: None
         """
-        # work only on the lowest level
-        # TODO: Allow this to be done for regions with different depths.
-        assert self.maxdepth == other.maxdepth, "Regions must have the same maxdepth"
-        self._demote_all()
-        opd = set(other.get_demoted())
-        self.pixeldict[self.maxdepth].difference_update(opd)
-        self._renorm()
+        self._set_ranges(ranges_op(self.get_ranges(), self._other_ranges(other, inner=True), lambda a, b: a & ~b))
         return
 
     def intersect(self, other):
         """
         intersect this region with another
+        If the other region has a greater maxdepth then pixels that are partly covered are kept.
         :param other: a region
         :return: None
         """
-        # work only on the lowest level
-        # TODO: Allow this to be done for regions with different depths.
-        assert self.maxdepth == other.maxdepth, "Regions must have the same maxdepth"
-        self._demote_all()
-        opd = set(other.get_demoted())
-        self.pixeldict[self.maxdepth].intersection_update(opd)
-        self._renorm()
+        self._set_ranges(ranges_op(self.get_ranges(), self._other_ranges(other), np.logical_and))
         return
 
     def symmetric_difference(self, other):
         """
-
-        :param other:
-        :return:
+        Keep the pixels that are in only one of this region or the other region.
+        If the other region has a greater maxdepth then pixels that are partly covered are kept.
+        :param other: a region
+        :return: None
         """
-        # work only on the lowest level
-        # TODO: Allow this to be done for regions with different depths.
-        assert self.maxdepth == other.maxdepth, "Regions must have the same maxdepth"
-        self._demote_all()
-        opd = set(other.get_demoted())
-        self.pixeldict[self.maxdepth].symmetric_difference_update(opd)
-        self._renorm()
+        inner = self._other_ranges(other, inner=True)
+        ranges = ranges_op(self.get_ranges(), inner, np.logical_xor)
+        if other.maxdepth > self.maxdepth:
+            # pixels that are partly covered by the other region are in the symmetric difference
+            partial = ranges_op(self._other_ranges(other), inner, lambda a, b: a & ~b)
+            ranges = ranges_op(ranges, partial, np.logical_or)
+        self._set_ranges(ranges)
         return
 
-    def write_reg(self, filename):
+    def write_reg(self, filename, degrees=False, merge=False):
         """
         Write a ds9 region file that represents this region as a set of diamonds.
         :param filename: file to write
+        :param degrees: If True then write the coordinates in decimal degrees instead of sexagesimal
+        :param merge: If True then adjacent pixels (at the same depth) are written as a single polygon
         :return: None
         """
         with open(filename, 'w') as out:
             for d in xrange(1, self.maxdepth+1):
-                for p in self.pixeldict[d]:
-                    line = "fk5; polygon("
-                    # the following int() gets around some problems with np.int64 that exist prior to numpy v 1.8.1
-                    vectors = zip(*hp.boundaries(2**d, int(p), step=1, nest=True))
-                    positions = []
-                    for sky in self.vec2sky(np.array(vectors), degrees=True):
-                        ra, dec = sky
-                        pos = SkyCoord(ra/15, dec, unit=(u.degree, u.degree))
-                        positions.append(pos.ra.to_string(sep=':', precision=2))
-                        positions.append(pos.dec.to_string(sep=':', precision=2))
-                    line += ','.join(positions)
-                    line += ")"
-                    print>>out, line
+                pix = np.fromiter(self.pixeldict[d], dtype=np.int64, count=len(self.pixeldict[d]))
+                if len(pix) == 0:
+                    continue
+                if merge:
+                    # sort into runs of pixels that are adjacent along the x axis of each base pixel
+                    x, y, f = hp.pix2xyf(2**d, pix, nest=True)
+                    order = np.lexsort((x, y, f))
+                    pix, x, y, f = pix[order], x[order], y[order], f[order]
+                    starts = np.flatnonzero(np.concatenate(([True], (np.diff(x) != 1) | (np.diff(y) != 0) |
+                                                            (np.diff(f) != 0))))
+                else:
+                    starts = np.arange(len(pix))
+                starts = np.append(starts, len(pix))
+                # process whole runs of pixels, about chunksize vertices at a time
+                step = max(self.chunksize // 4, 1)
+                lo = 0
+                while lo < len(starts) - 1:
+                    hi = max(np.searchsorted(starts, starts[lo] + step, side='right') - 1, lo + 1)
+                    first, last = starts[lo], starts[hi]
+                    # corners are N, W, S, E
+                    vectors = hp.boundaries(2**d, pix[first:last], step=1, nest=True).reshape(-1, 3, 4)
+                    theta, phi = hp.vec2ang(vectors.transpose(0, 2, 1).reshape(-1, 3))
+                    corners = np.array(_format_coords(np.degrees(phi), np.degrees(np.pi/2 - theta), degrees))
+                    corners = corners.reshape(-1, 4)
+                    for a, b in zip(starts[lo:hi] - first, starts[lo+1:hi+1] - first):
+                        if b - a == 1:
+                            positions = corners[a]
+                        else:
+                            # S and E along the bottom, then N and W along the top
+                            positions = [corners[a, 2]]
+                            positions.extend(corners[a:b, 3])
+                            positions.extend(corners[a:b, 0][::-1])
+                            positions.append(corners[a, 1])
+                        print>>out, "fk5; polygon(" + ','.join(positions) + ")"
+                    lo = hi
         return
 
     def write_fits(self, filename, moctool=''):
@@ -262,16 +475,53 @@ class Region(object):
         hdulist.writeto(filename, clobber=True)
         return
 
+    @classmethod
+    def from_fits(cls, filename, maxdepth=None):
+        """
+        Create a region from a MOC fits file that uses NUNIQ ordering (eg one created by write_fits).
+        The file is memory mapped and the region is stored as ranges of pixels. The pixel sets (pixeldict)
+        are only built if they are accessed, so eg sky_within does not need them.
+        :param filename: Input filename
+        :param maxdepth: The maxdepth of the new region. Default = MOCORDER from the file header,
+                         or the highest order in the file.
+                         Pixels of higher order than maxdepth are included if they partly cover a pixel at maxdepth.
+        :return: A Region
+        """
+        hdulist = fits.open(filename, memmap=True)
+        uniq = np.asarray(hdulist[1].data.field(0), dtype=np.int64)
+        # NUNIQ = 4*4**order + ipix, with 0 <= ipix < 12*4**order
+        order = np.zeros(len(uniq), dtype=np.int64)
+        for d in xrange(1, 30):
+            order[uniq >= 4**(d+1)] = d
+        if maxdepth is None:
+            maxdepth = hdulist[1].header.get('MOCORDER', int(order.max()) if len(order) > 0 else 11)
+        hdulist.close()
+        ipix = uniq - 4**(order + 1)
+        shift = 2 * (maxdepth - order)
+        coarse = shift >= 0
+        starts = np.empty(len(uniq), dtype=np.int64)
+        stops = np.empty(len(uniq), dtype=np.int64)
+        starts[coarse] = ipix[coarse] << shift[coarse]
+        stops[coarse] = (ipix[coarse] + 1) << shift[coarse]
+        # pixels that are smaller than those at maxdepth
+        fine = ~coarse
+        starts[fine] = ipix[fine] >> -shift[fine]
+        stops[fine] = starts[fine] + 1
+        region = cls(maxdepth)
+        region._set_ranges(merge_ranges(starts, stops))
+        return region
+
     def _uniq(self):
         """
         Create a list of all the pixels that cover this region.
         This list contains overlapping pixels of different orders.
         :return: A list of HealPix pixel numbers.
         """
-        pd = []
-        for d in xrange(1, self.maxdepth):
-            pd.extend(map(lambda x: int(4**(d+1) + x), self.pixeldict[d]))
-        return sorted(pd)
+        pd = [np.zeros(0, dtype=np.int64)]
+        for d in xrange(1, self.maxdepth+1):
+            pix = np.fromiter(self.pixeldict[d], dtype=np.int64, count=len(self.pixeldict[d]))
+            pd.append(4**(d+1) + pix)
+        return np.sort(np.concatenate(pd))
 
     @staticmethod
     def radec2sky(ra, dec):
@@ -476,6 +726,10 @@ def test_pickle():
     pickle.dump(region,open('out.mim', 'w'))
     region2 = pickle.load(open('out.mim'))
     assert region.pixeldict == region2.pixeldict, 'pickle/unpickle does not give same region'
+    # regions pickled before the pixels were built lazily
+    region3 = Region.__new__(Region)
+    region3.__setstate__({'maxdepth': 8, 'pixeldict': region.pixeldict, 'demoted': set()})
+    assert np.all(region3.get_ranges() == region.get_ranges()), 'unpickling an old region failed'
     print 'test_pickle PASSED'
     return
 
@@ -494,6 +748,21 @@ def test_reg():
     print 'test_reg PASSED'
 
 
+def test_reg_merge():
+    """
+    Test that merging pixels reduces the number of polygons in a .reg file
+    """
+    region = Region(maxdepth=9)
+    region.add_circles(np.radians(285), np.radians(-66), np.radians(3))
+    region.write_reg('test.reg')
+    nlines = len(open('test.reg').readlines())
+    region.write_reg('test.reg', degrees=True, merge=True)
+    lines = open('test.reg').readlines()
+    assert 0 < len(lines) < nlines, "Merging pixels didn't reduce the number of polygons"
+    assert ':' not in lines[0], "Coordinates not written in degrees"
+    print 'test_reg_merge PASSED'
+
+
 def test_poly():
     """
     Test that polygon regions can be added and written to .reg files
@@ -516,6 +785,22 @@ def test_write_fits():
     return
 
 
+def test_read_fits():
+    """ Test that MOC files can be read back in """
+    a = Region(maxdepth=9)
+    a.add_circles(np.radians(12), 0, np.radians(3))
+    a.write_fits('test_MOC.fits')
+    b = Region.from_fits('test_MOC.fits')
+    assert b.maxdepth == a.maxdepth, "read_fits has the wrong maxdepth"
+    b.sky_within(np.radians([12, 20]), [0, 0])
+    assert b._pixeldict is None, "read_fits/sky_within created the pixel sets"
+    for d in xrange(1, a.maxdepth+1):
+        if a.pixeldict[d] != b.pixeldict[d]:
+            raise Exception("read_fits FAILED")
+    print 'read_fits PASSED'
+    return
+
+
 def test_without():
     """
     Test the Region.without gives expected results"
@@ -584,10 +869,73 @@ def test_symmetric_difference():
     return
 
 
+def test_mixed_depths():
+    """
+    Test the set operations for regions with different maxdepths
+    """
+    np.random.seed(1)
+    ra = np.random.uniform(0, 20, 10000)
+    dec = np.random.uniform(-10, 10, 10000)
+    for da, db in [(7, 10), (10, 7)]:
+        a = Region(maxdepth=da)
+        a.add_circles(np.radians(8), np.radians(0), np.radians(5))
+        b = Region(maxdepth=db)
+        b.add_circles(np.radians(12), np.radians(0), np.radians(4))
+        in_a = a.sky_within(ra, dec, degin=True)
+        in_b = b.sky_within(ra, dec, degin=True)
+        for op, expected in [('union', in_a | in_b), ('intersect', in_a & in_b),
+                             ('without', in_a & ~in_b), ('symmetric_difference', in_a ^ in_b)]:
+            c = Region(maxdepth=da)
+            c.union(a)
+            getattr(c, op)(b)
+            inside = c.sky_within(ra, dec, degin=True)
+            if da >= db:
+                assert np.all(inside == expected), "{0} failed for depths {1},{2}".format(op, da, db)
+            else:
+                # pixels that are partly covered are included
+                assert np.all(inside[expected]), "{0} failed for depths {1},{2}".format(op, da, db)
+            if op in ['intersect', 'without']:
+                assert np.all(in_a[inside]), "{0} failed for depths {1},{2}".format(op, da, db)
+    print "test_mixed_depths PASSED"
+    return
+
+
+def test_ranges():
+    """
+    Test the range operations used by Region
+    """
+    r = merge_ranges([5, 0, 3, 10], [7, 2, 5, 12])
+    assert r.tolist() == [[0, 2], [3, 7], [10, 12]], "merge_ranges FAILED"
+    assert ranges_within(r, [0, 2, 6, 7, 11]).tolist() == [True, False, True, False, True], "ranges_within FAILED"
+    a = merge_ranges([0, 10], [5, 15])
+    b = merge_ranges([3], [12])
+    assert ranges_op(a, b, np.logical_or).tolist() == [[0, 15]], "union of ranges FAILED"
+    assert ranges_op(a, b, np.logical_and).tolist() == [[3, 5], [10, 12]], "intersection of ranges FAILED"
+    assert ranges_op(a, b, np.logical_xor).tolist() == [[0, 3], [5, 10], [12, 15]], "xor of ranges FAILED"
+    print "test_ranges PASSED"
+    return
+
+
+def test_set_ranges():
+    """
+    Test that Region._set_ranges gives the same pixels as Region._renorm
+    """
+    a = Region(maxdepth=9)
+    a.add_circles(np.radians(30), np.radians(-20), np.radians(5))
+    b = Region(maxdepth=9)
+    b._set_ranges(a.get_ranges())
+    for d in xrange(1, a.maxdepth+1):
+        if a.pixeldict[d] != b.pixeldict[d]:
+            raise Exception("test_set_ranges FAILED")
+    print "test_set_ranges PASSED"
+    return
+
+
 if __name__ == "__main__":
     print 'Running tests....'
     test_vec2sky_corners()
     test_reg()
+    test_reg_merge()
     test_radec2sky()
     test_sky2ang_symmetric()
     test_sky2ang_corners()
@@ -599,8 +947,12 @@ if __name__ == "__main__":
     test_pickle()
     test_sky2vec_corners()
     test_write_fits()
+    test_read_fits()
     test_demote()
     test_without()
     test_intersect()
     test_symmetric_difference()
+    test_mixed_depths()
+    test_ranges()
+    test_set_ranges()
     print "all tests PASSED"
@@ -6,6 +6,7 @@ The Aegean source finding program.
 # standard imports
 import sys
 import os
+import time
 import numpy as np
 import math
 import copy
@@ -18,12 +19,12 @@ from scipy.special import erf
 from scipy.ndimage import label, find_objects
 
 # AegeanTools
-from fitting import do_lmfit, Cmatrix, Bmatrix, errors, covar_errors, ntwodgaussian_lmfit, \
+from fitting import do_lmfit, correlation_matrices, batch_errors, covar_errors, ntwodgaussian_lmfit, \
                     bias_correct, elliptical_gaussian
 from wcs_helpers import WCSHelper, PSFHelper
 from fits_image import FitsImage
 from msq2 import MarchingSquares
-from angle_tools import dec2hms, dec2dms, gcd, bear
+from angle_tools import dec2hms, dec2dms, gcd, bear, farthest_pair
 from catalogs import load_table, table_to_source_list
 from models import OutputSource, IslandSource, island_itergen
 import flags
@@ -32,6 +33,7 @@ import flags
 # This can fail if healpy is not installed
 try:
     from regions import Region
+    from MIMAS import cached_region_mask, load_region
 
     region_available = True
     try:
@@ -54,6 +56,14 @@ header = """#Aegean version {0}
 CC2FHWM = (2 * math.sqrt(2 * math.log(2)))
 FWHM2CC = 1 / CC2FHWM
 
+# per-island profiling statistics, one row per island
+# times are wall clock seconds spent on: parameter estimation, correlation matrices, fitting,
+# pixel based errors (and bias correction), conversion to sky coordinates, and the island as a whole
+island_stats_dtype = [('island', np.int32), ('pixels', np.int32), ('components', np.int16), ('free', np.int16),
+                      ('nfev', np.int32), ('t_parinfo', np.float32), ('t_cmatrix', np.float32),
+                      ('t_fit', np.float32), ('t_errors', np.float32), ('t_wcs', np.float32),
+                      ('t_total', np.float32)]
+
 
 class GlobalFittingData(object):
     """
@@ -72,9 +82,11 @@ class GlobalFittingData(object):
         self.data_pix = None
         self.dtype = None
         self.region = None
+        self.region_mask = None
         self.wcshelper = None
         self.psfhelper = None
         self.blank = False
+        self.warmstart = None
         return
 
 
@@ -107,6 +119,71 @@ class DummyLM(object):
         self.success = False
 
 
+class CurvatureMap(object):
+    """
+    The sign of the curvature of an image, stored as 2 bits per pixel.
+    Local maxima (peaks) are -1, local minima (troughs) are +1, and everything else is 0.
+    A pixel that is both (eg in a flat region) is +1.
+    Slicing a CurvatureMap returns an int8 array of the corresponding section.
+    """
+    # packed code -> curvature value
+    _decode = np.array([0, 1, 0, -1], dtype=np.int8)
+
+    def __init__(self, data, block=256):
+        """
+        :param data: 2d image
+        :param block: the number of rows to process at once
+        """
+        self.shape = data.shape
+        nx, ny = self.shape
+        self.packed = np.zeros((nx, (ny + 3) // 4), dtype=np.uint8)
+        for lo in xrange(0, nx, block):
+            hi = min(lo + block, nx)
+            # include a halo of rows so that the 3x3 filters are the same as for the whole image
+            # (scipy's running min/max is affected by pixels just outside the window when there are nans)
+            blo, bhi = max(lo - 2, 0), min(hi + 2, nx)
+            chunk = data[blo:bhi]
+            inner = chunk[lo - blo:hi - blo]
+            codes = np.zeros((hi - lo, 4 * self.packed.shape[1]), dtype=np.uint8)
+            peaks = scipy.ndimage.filters.maximum_filter(chunk, size=3)[lo - blo:hi - blo]
+            codes[:, :ny][inner == peaks] = 3
+            del peaks
+            troughs = scipy.ndimage.filters.minimum_filter(chunk, size=3)[lo - blo:hi - blo]
+            codes[:, :ny][inner == troughs] = 1
+            del troughs
+            codes = codes.reshape(hi - lo, -1, 4)
+            self.packed[lo:hi] = codes[..., 0] | (codes[..., 1] << 2) | (codes[..., 2] << 4) | (codes[..., 3] << 6)
+        return
+
+    def _unpack(self, packed):
+        """
+        Convert packed bytes into curvature values, 4 per byte.
+        :param packed: array of packed bytes
+        :return: int8 array with a last axis 4 times as long
+        """
+        codes = (packed[..., np.newaxis] >> np.array([0, 2, 4, 6], dtype=np.uint8)) & 3
+        return self._decode[codes.reshape(packed.shape[:-1] + (4 * packed.shape[-1],))]
+
+    def __getitem__(self, item):
+        if not isinstance(item, tuple):
+            item = (item, slice(None))
+        rows, cols = item
+        packed = self.packed[rows]
+        if isinstance(cols, slice) and cols.step in (None, 1):
+            # only unpack the bytes that are needed
+            start, stop, _ = cols.indices(self.shape[1])
+            stop = max(start, stop)
+            b0, b1 = start // 4, (stop + 3) // 4
+            return self._unpack(packed[..., b0:b1])[..., start - 4 * b0:stop - 4 * b0]
+        return self._unpack(packed)[..., :self.shape[1]][..., cols]
+
+    def __array__(self, dtype=None):
+        curve = self[:, :]
+        if dtype is not None:
+            curve = curve.astype(dtype)
+        return curve
+
+
 class SourceFinder(object):
     """
     The Aegean source finding program
@@ -123,10 +200,12 @@ class SourceFinder(object):
         self.global_data.data_pix = None
         self.global_data.dtype = None
         self.global_data.region = None
+        self.global_data.region_mask = None
         self.global_data.wcshelper = None
         self.global_data.psfhelper = None
 
         self.sources = []
+        self.island_stats = np.zeros(0, dtype=island_stats_dtype)
         self.log = None
 
         for k in kwargs:
@@ -166,8 +245,17 @@ class SourceFinder(object):
             self.log.debug("There are no pixels above the clipping limit")
             return
         self.log.debug("{1} Found {0} islands total above flood limit".format(n, data.shape))
+        # islands that have at least one pixel within the region mask
+        in_region = None
+        if domask and (self.global_data.region_mask is not None):
+            in_region = np.zeros(n + 1, dtype=bool)
+            in_region[np.unique(l[a & self.global_data.region_mask])] = True
+            self.log.debug("{0} islands are within the region".format(in_region[1:].sum()))
         # Yield values as before, though they are not sorted by flux
         for i in range(n):
+            # skip islands that are outside of the region mask
+            if in_region is not None and not in_region[i + 1]:
+                continue
             xmin, xmax = f[i][0].start, f[i][0].stop
             ymin, ymax = f[i][1].start, f[i][1].stop
             if np.any(snr[xmin:xmax, ymin:ymax] > innerclip):  # obey inner clip constraint
@@ -180,16 +268,6 @@ class SourceFinder(object):
                 if not np.any(np.isfinite(data_box)):
                     #self.log.info("{1} Island {0} has no non-masked pixels".format(i,data.shape))
                     continue
-                if domask and (self.global_data.region is not None):
-                    y, x = np.where(snr[xmin:xmax, ymin:ymax] >= outerclip)
-                    # convert indices of this sub region to indices in the greater image
-                    yx = zip(y + ymin, x + xmin)
-                    ra, dec = self.global_data.wcshelper.wcs.wcs_pix2world(yx, 1).transpose()
-                    mask = self.global_data.region.sky_within(ra, dec, degin=True)
-                    # if there are no un-masked pixels within the region then we skip this island.
-                    if not np.any(mask):
-                        continue
-                    self.log.debug("Mask {0}".format(mask))
                 #self.log.info("{1} Island {0} will be fit".format(i, data.shape))
                 yield data_box, xmin, xmax, ymin, ymax
 
@@ -407,6 +485,138 @@ class SourceFinder(object):
             self.log.debug("Considered {0} summits, accepted {1}".format(summits_considered, i))
         return params
 
+    def warmstart_lmfit_parinfo(self, data, rmsimg, innerclip, outerclip=None, offsets=(0, 0), max_summits=None):
+        """
+        Create the initial parameters for the fit of an island using the components of a reference
+        catalogue (global_data.warmstart) that fall within the island.
+        The reference components are only used when the match is unambiguous, that is when:
+         - the island is not so small that it would be fit as a single point source,
+         - at least one reference component falls on a (finite) pixel of the island,
+         - no reference component falls just outside the island,
+         - no two reference components fall on the same pixel,
+         - all the reference components have the same sign as the island, and
+         - the peak (snr) pixel of the island is within half a beam of a reference component.
+
+        :param data: np.ndarray of flux values
+        :param rmsimg: np.ndarray of 1sigma values
+        :param innerclip: the inner clipping level for flux data, in sigmas
+        :param outerclip: the outer clipping level for flux data, in sigmas
+        :param offsets: the (x,y) offset of data within it's parent image
+        :param max_summits: if not None, only this many components will be fit.
+        :return: an lmfit.Parameters object that describes our model, or None if the match is ambiguous
+        """
+        global_data = self.global_data
+        refs = global_data.warmstart
+        xmin, ymin = offsets
+        xsize, ysize = data.shape
+
+        if outerclip is None:
+            outerclip = innerclip
+
+        finite = np.isfinite(data)
+        # small islands are fit as point sources so we leave them to estimate_lmfit_parinfo
+        if min(data.shape) <= 2 or np.count_nonzero(finite) <= 6:
+            return None
+
+        # select the reference components that are within (or next to) the bounding box of this island
+        # refs are sorted by x so we only need to search part of the list
+        lo, hi = np.searchsorted(refs[:, 0], [xmin - 1.5, xmin + xsize + 0.5])
+        cand = refs[lo:hi]
+        xo = cand[:, 0] - xmin
+        yo = cand[:, 1] - ymin
+        xi = np.round(xo).astype(int)
+        yi = np.round(yo).astype(int)
+        inside = (-1 <= xi) & (xi <= xsize) & (-1 <= yi) & (yi <= ysize)
+        cand, xo, yo, xi, yi = cand[inside], xo[inside], yo[inside], xi[inside], yi[inside]
+        # components that fall next to, but not on, the island may belong to it
+        # (a fitted position can be just outside the island) so we don't know the model
+        padded = np.pad(finite, 2, mode='constant')
+        near = np.zeros(len(cand), dtype=bool)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                near |= padded[xi + dx + 2, yi + dy + 2]
+        inside = padded[xi + 2, yi + 2]
+        if np.any(near & ~inside):
+            self.log.debug("Reference component(s) on the edge of the island")
+            return None
+        cand, xo, yo, xi, yi = cand[inside], xo[inside], yo[inside], xi[inside], yi[inside]
+
+        if len(cand) < 1:
+            self.log.debug("No reference components within island")
+            return None
+        if len(set(zip(xi, yi))) < len(cand):
+            self.log.debug("Multiple reference components share a pixel")
+            return None
+        isnegative = max(data[finite]) < 0
+        if np.any((cand[:, 5] < 0) != isnegative):
+            self.log.debug("Reference components have the wrong sign")
+            return None
+
+        # if the brightest part of the island is not near a reference component then
+        # something has changed and we need to look at this island afresh
+        xpeak, ypeak = np.unravel_index(np.nanargmax(abs(data / rmsimg)), data.shape)
+        pixbeam = global_data.psfhelper.get_pixbeam_pixel(xpeak + xmin, ypeak + ymin)
+        if pixbeam is None:
+            return None
+        if min(np.hypot(xo - xpeak, yo - ypeak)) > 0.5 * np.hypot(pixbeam.a, pixbeam.b):
+            self.log.debug("Island peak is not near a reference component")
+            return None
+
+        params = lmfit.Parameters()
+        # add components in order of brightness, as for estimate_lmfit_parinfo
+        order = np.argsort(-1. * abs(data[xi, yi]))
+        for i, k in enumerate(order):
+            # the amplitude limits are set from this image since the sources may be variable
+            amp = data[xi[k], yi[k]]
+            rms = rmsimg[xi[k], yi[k]]
+            if amp > 0:
+                amp_min, amp_max = 0.95 * min(outerclip * rms, amp), amp * 1.05 + innerclip * rms
+            else:
+                amp_max, amp_min = 0.95 * max(-outerclip * rms, amp), amp * 1.05 - innerclip * rms
+            # but the reference amplitude is a better starting point, if it is allowed
+            if amp_min < cand[k, 5] < amp_max:
+                amp = cand[k, 5]
+
+            pixbeam = global_data.psfhelper.get_pixbeam_pixel(xo[k] + xmin, yo[k] + ymin)
+            if pixbeam is None:
+                return None
+
+            xo_lim = yo_lim = 0.5 * np.hypot(pixbeam.a, pixbeam.b)
+
+            # constraints are the same as those in estimate_lmfit_parinfo
+            psf_sy = pixbeam.b * FWHM2CC
+            psf_sx = max(pixbeam.a * FWHM2CC, psf_sy * 1.01)
+            s_min = psf_sy * 0.8
+            s_max = max((max(xsize, ysize) + 1) * math.sqrt(2) * FWHM2CC, psf_sx * 1.1)
+            # start within (not at) the limits, or lmfit will be unable to determine the errors
+            sx = min(max(cand[k, 2], s_min * 1.01), s_max * 0.99)
+            sy = min(max(cand[k, 3], s_min * 1.01), s_max * 0.99)
+            # lmfit does silly things if we start with these two parameters being equal
+            sx = max(sx, sy * 1.01)
+            theta = cand[k, 4]
+
+            # check to see if we are going to fit this component
+            maxxed = max_summits is not None and i >= max_summits
+            summit_flag = 0
+            if maxxed:
+                summit_flag |= flags.NOTFIT
+                summit_flag |= flags.FIXED2PSF
+
+            prefix = "c{0}_".format(i)
+            params.add(prefix + 'amp', value=amp, min=amp_min, max=amp_max, vary=not maxxed)
+            params.add(prefix + 'xo', value=xo[k], min=float(xo[k] - xo_lim), max=float(xo[k] + xo_lim),
+                       vary=not maxxed)
+            params.add(prefix + 'yo', value=yo[k], min=float(yo[k] - yo_lim), max=float(yo[k] + yo_lim),
+                       vary=not maxxed)
+            params.add(prefix + 'sx', value=sx, min=s_min, max=s_max, vary=not maxxed)
+            params.add(prefix + 'sy', value=sy, min=s_min, max=s_max, vary=not maxxed)
+            params.add(prefix + 'theta', value=theta, vary=not maxxed)
+            params.add(prefix + 'flags', value=summit_flag, vary=False)
+
+        self.log.debug("Warm start with {0} components".format(len(order)))
+        params.add('components', value=len(order), vary=False)
+        return params
+
     def result_to_components(self, result, model, island_data, isflags):
         """
         Convert fitting results into a set of components
@@ -430,9 +640,19 @@ class SourceFinder(object):
         residual = np.median(result.residual), np.std(result.residual)
         is_flag = isflags
 
+        # convert all the components to sky coords at once
+        # pixel pos within island + island offset within region + region offset within image + 1 for luck
+        ncomp = model['components'].value
+        pars = [[model["c{0}_{1}".format(j, p)].value for j in range(ncomp)] for p in ['xo', 'yo', 'sx', 'sy', 'theta']]
+        pars = np.array(pars, dtype=float).reshape(5, ncomp)
+        sky_ellipses = global_data.wcshelper.pix2sky_ellipse_many(pars[0] + xmin + 1, pars[1] + ymin + 1,
+                                                                  pars[2] * CC2FHWM, pars[3] * CC2FHWM, pars[4])
+
         sources = []
+        # the final flags for each source, these are applied after the error calculations
+        src_flag_list = []
         j = 0
-        for j in range(model['components'].value):
+        for j in range(ncomp):
             src_flags = is_flag
             source = OutputSource()
             source.island = isle_num
@@ -476,10 +696,7 @@ class SourceFinder(object):
             source.peak_flux = amp
 
             # all params are in degrees
-            source.ra, source.dec, source.a, source.b, source.pa = global_data.wcshelper.pix2sky_ellipse((x_pix, y_pix),
-                                                                                                         sx * CC2FHWM,
-                                                                                                         sy * CC2FHWM,
-                                                                                                         theta)
+            source.ra, source.dec, source.a, source.b, source.pa = [v[j] for v in sky_ellipses]
             source.a *= 3600  # arcseconds
             source.b *= 3600
             # force a>=b
@@ -501,10 +718,7 @@ class SourceFinder(object):
             # scale Jy/beam -> Jy using the area of the beam
             source.int_flux /= global_data.psfhelper.get_beamarea_pix(source.ra, source.dec)
 
-            # Calculate errors for params that were fit (as well as int_flux)
-            errors(source, model, global_data.wcshelper)
-
-            source.flags = src_flags
+            src_flag_list.append(src_flags)
             # add psf info
             local_beam = global_data.psfhelper.get_beam(source.ra, source.dec)
             if local_beam is not None:
@@ -516,6 +730,13 @@ class SourceFinder(object):
                 source.psf_b = 0
                 source.psf_pa = 0
             sources.append(source)
+
+        # Calculate errors for params that were fit (as well as int_flux)
+        # for all the components at once
+        batch_errors(sources, model, global_data.wcshelper)
+        # the errors are calculated using the fitting flags only, and then the final flags are set
+        for source, src_flags in zip(sources, src_flag_list):
+            source.flags = src_flags
             self.log.debug(source)
 
         if global_data.blank:
@@ -577,17 +798,16 @@ class SourceFinder(object):
             # create contours
             msq = MarchingSquares(idata)
             source.contour = [(a[0] + xmin, a[1] + ymin) for a in msq.perimeter]
-            # calculate the maximum angular size of this island, brute force method
+            # calculate the maximum angular size of this island
             source.max_angular_size = 0
-            for i, pos1 in enumerate(source.contour):
-                radec1 = global_data.wcshelper.pix2sky(pos1)
-                for j, pos2 in enumerate(source.contour[i:]):
-                    radec2 = global_data.wcshelper.pix2sky(pos2)
-                    dist = gcd(radec1[0], radec1[1], radec2[0], radec2[1])
-                    if dist > source.max_angular_size:
-                        source.max_angular_size = dist
-                        source.pa = bear(radec1[0], radec1[1], radec2[0], radec2[1])
-                        source.max_angular_size_anchors = [pos1[0], pos1[1], pos2[0], pos2[1]]
+            contour_ra, contour_dec = global_data.wcshelper.pix2sky_many([a[0] for a in source.contour],
+                                                                         [a[1] for a in source.contour])
+            i, j, dist = farthest_pair(contour_ra, contour_dec)
+            if dist > 0:
+                pos1, pos2 = source.contour[i], source.contour[j]
+                source.max_angular_size = dist
+                source.pa = bear(contour_ra[i], contour_dec[i], contour_ra[j], contour_dec[j])
+                source.max_angular_size_anchors = [pos1[0], pos1[1], pos2[0], pos2[1]]
 
             self.log.debug("- peak position {0}, {1} [{2},{3}]".format(source.ra_str, source.dec_str, positions[0][0],
                                                                        positions[1][0]))
@@ -615,7 +835,8 @@ class SourceFinder(object):
     # Setting up 'global' data and calculating bkg/rms
     ##
     def load_globals(self, filename, hdu_index=0, bkgin=None, rmsin=None, beam=None, verb=False, rms=None, cores=1,
-                     do_curve=True, mask=None, lat=None, psf=None, blank=False, docov=True, slice=slice):
+                     do_curve=True, mask=None, lat=None, psf=None, blank=False, docov=True, slice=slice,
+                     beamgrid=None, memmap=False, dtype=None, maskcache=None, psfinterp=False):
         """
         Populate the global_data object by loading or calculating the various components
 
@@ -634,12 +855,19 @@ class SourceFinder(object):
         :param blank: True = blank output image where islands are found
         :param docov: True = use covariance matrix in fitting
         :param slice: For an image cube, which slice to use.
+        :param beamgrid: If not None, precompute the pixel beam on a grid with this spacing (pixels)
+                         and interpolate it when estimating components.
+        :param memmap: True = memory map the image (and bkg/rms images) rather than reading them into memory.
+                       Pixels that are modified (eg the background subtracted image) are copied into memory.
+        :param dtype: The data type used for the image (and bkg/rms images), eg np.float32. Default = as per file.
+        :param maskcache: A directory in which the rasterised mask is cached. Default = None = no caching.
+        :param psfinterp: True = interpolate the psf map rather than using the nearest pixel.
         :return: None
         """
         # don't reload already loaded data
         if self.global_data.img is not None:
             return
-        img = FitsImage(filename, hdu_index=hdu_index, beam=beam, slice=slice)
+        img = FitsImage(filename, hdu_index=hdu_index, beam=beam, slice=slice, memmap=memmap, dtype=dtype)
         beam = img.beam
 
         debug = logging.getLogger('Aegean').isEnabledFor(logging.DEBUG)
@@ -655,17 +883,25 @@ class SourceFinder(object):
                 self.global_data.region = mask
             elif os.path.exists(mask):
                 self.log.info("Loading mask from {0}".format(mask))
-                self.global_data.region = pickle.load(open(mask))
+                self.global_data.region = load_region(mask)
             else:
                 self.log.error("File {0} not found for loading".format(mask))
                 self.global_data.region = None
 
         self.global_data.wcshelper = WCSHelper.from_header(img.get_hdu_header(), beam, lat)
-        self.global_data.psfhelper = PSFHelper(psf, self.global_data.wcshelper)
+        self.global_data.psfhelper = PSFHelper(psf, self.global_data.wcshelper, interpolate=psfinterp)
+        if self.global_data.region is not None:
+            # rasterise the region onto the image so that islands can be rejected before they are fit
+            self.global_data.region_mask = cached_region_mask(img.get_pixels().shape, self.global_data.wcshelper.wcs,
+                                                              self.global_data.region, maskcache)
+        else:
+            self.global_data.region_mask = None
 
         self.global_data.beam = self.global_data.wcshelper.beam
         self.global_data.img = img
         self.global_data.data_pix = img.get_pixels()
+        if beamgrid is not None:
+            self.global_data.psfhelper.make_pixbeam_grid(self.global_data.data_pix.shape, step=beamgrid)
         self.global_data.dtype = type(self.global_data.data_pix[0][0])
         self.global_data.bkgimg = np.zeros(self.global_data.data_pix.shape, dtype=self.global_data.dtype)
         self.global_data.rmsimg = np.zeros(self.global_data.data_pix.shape, dtype=self.global_data.dtype)
@@ -675,14 +911,7 @@ class SourceFinder(object):
         if do_curve:
             self.log.info("Calculating curvature")
             # calculate curvature but store it as -1,0,+1
-            dcurve = np.zeros(self.global_data.data_pix.shape, dtype=np.int8)
-            peaks = scipy.ndimage.filters.maximum_filter(self.global_data.data_pix, size=3)
-            troughs = scipy.ndimage.filters.minimum_filter(self.global_data.data_pix, size=3)
-            pmask = np.where(self.global_data.data_pix == peaks)
-            tmask = np.where(self.global_data.data_pix == troughs)
-            dcurve[pmask] = -1
-            dcurve[tmask] = 1
-            self.global_data.dcurve = dcurve
+            self.global_data.dcurve = CurvatureMap(self.global_data.data_pix)
 
         # if either of rms or bkg images are not supplied then calculate them both
         if not (rmsin and bkgin):
@@ -708,7 +937,7 @@ class SourceFinder(object):
         if verb and debug:
             self.log.debug("Data max is {0}".format(img.get_pixels()[np.isfinite(img.get_pixels())].max()))
             self.log.debug("Doing background subtraction")
-        img.set_pixels(img.get_pixels() - self.global_data.bkgimg)
+        img.subtract(self.global_data.bkgimg)
         self.global_data.data_pix = img.get_pixels()
         if verb and debug:
             self.log.debug("Data max is {0}".format(img.get_pixels()[np.isfinite(img.get_pixels())].max()))
@@ -940,7 +1169,7 @@ class SourceFinder(object):
         :param auxfile: filename of auxiliary file to be loaded
         :return: FitsImage(auxfile)
         """
-        auximg = FitsImage(auxfile, beam=self.global_data.beam).get_pixels()
+        auximg = FitsImage(auxfile, beam=self.global_data.beam, memmap=image.memmap, dtype=image.dtype).get_pixels()
         if auximg.shape != image.get_pixels().shape:
             self.log.error("file {0} is not the same size as the image map".format(auxfile))
             self.log.error("{0}= {1}, image = {2}".format(auxfile, auximg.shape, image.get_pixels().shape))
@@ -950,6 +1179,32 @@ class SourceFinder(object):
     ##
     # Fitting and refitting
     ##
+    def _load_warmstart(self, catalogue):
+        """
+        Convert a reference catalogue into the pixel based parameters that are used to seed
+        the fitting of islands. The result is stored in global_data.warmstart as an array of
+        (x, y, sx, sy, theta, peak_flux), sorted by x.
+
+        :param catalogue: catalogue file name, or a list of OutputSource objects
+        :return: None
+        """
+        if isinstance(catalogue, (str, unicode)):
+            input_sources = table_to_source_list(load_table(catalogue))
+        else:
+            input_sources = catalogue
+
+        # islands can't be used to seed the fitting
+        comps = [src for src in input_sources if isinstance(src, OutputSource)]
+        pars = np.array([[src.ra, src.dec, src.a / 3600, src.b / 3600, src.pa, src.peak_flux] for src in comps],
+                        dtype=float).reshape(-1, 6)
+        x, y, sx, sy, theta = self.global_data.wcshelper.sky2pix_ellipse_many(*pars[:, :5].T)
+        # convert from fits to numpy pixel coordinates and from fwhm to sigma
+        refs = np.array([x - 1, y - 1, sx * FWHM2CC, sy * FWHM2CC, theta, pars[:, 5]]).T
+        refs = refs[np.all(np.isfinite(refs), axis=1)]
+        self.global_data.warmstart = refs[np.argsort(refs[:, 0])]
+        self.log.info("Warm start from {0} of {1} reference components".format(len(refs), len(input_sources)))
+        return
+
     def _refit_islands(self, group, stage, outerclip=None, istart=0):
         """
         Do island refitting (priorized fitting) on a group of islands.
@@ -958,7 +1213,7 @@ class SourceFinder(object):
         :param stage: refit stage
         :param outerclip: ignored, placed holder for future development
         :param istart: the starting island number
-        :return: a list of sources (including islands)
+        :return: (sources, stats) a list of sources (including islands) and an array of island_stats_dtype
         """
         global_data = self.global_data
         sources = []
@@ -966,7 +1221,12 @@ class SourceFinder(object):
         data = global_data.data_pix
         rmsimg = global_data.rmsimg
 
-        for inum, isle in enumerate(group, start=istart):
+        stats = np.zeros(len(group), dtype=island_stats_dtype)
+        # the start time of each island, the difference is the time taken per island
+        starts = np.zeros(len(group) + 1)
+        for k, (inum, isle) in enumerate(enumerate(group, start=istart)):
+            starts[k] = time.time()
+            stats[k]['island'] = inum
             self.log.debug("-=-")
             self.log.debug("input island = {0}, {1} components".format(isle[0].island, len(isle)))
 
@@ -982,12 +1242,15 @@ class SourceFinder(object):
             # keep track of the sources that are actually being refit
             # this may be a subset of all sources in the island
             included_sources = []
-            for src in isle:
+            # convert all the sources to pixel coordinates at once
+            isle_x, isle_y, isle_sx, isle_sy, isle_theta = global_data.wcshelper.sky2pix_ellipse_many(
+                [src.ra for src in isle], [src.dec for src in isle], [src.a / 3600 for src in isle],
+                [src.b / 3600 for src in isle], [src.pa for src in isle])
+            for n, src in enumerate(isle):
                 pixbeam = global_data.psfhelper.get_pixbeam(src.ra, src.dec)
                 # find the right pixels from the ra/dec
-                source_x, source_y = global_data.wcshelper.sky2pix([src.ra, src.dec])
-                source_x -= 1
-                source_y -= 1
+                source_x = isle_x[n] - 1
+                source_y = isle_y[n] - 1
                 x = int(round(source_x))
                 y = int(round(source_y))
 
@@ -1003,10 +1266,9 @@ class SourceFinder(object):
                     # Keep track of the last source to have a valid psf so that we can use it later on
                     src_valid_psf = src
                 # determine the shape parameters in pixel values
-                _, _, sx, sy, theta = global_data.wcshelper.sky2pix_ellipse([src.ra, src.dec], src.a / 3600,
-                                                                            src.b / 3600, src.pa)
-                sx *= FWHM2CC
-                sy *= FWHM2CC
+                sx = isle_sx[n] * FWHM2CC
+                sy = isle_sy[n] * FWHM2CC
+                theta = isle_theta[n]
 
                 self.log.debug("Source shape [sky coords]  {0:5.2f}x{1:5.2f}@{2:05.2f}".format(src.a, src.b, src.pa))
                 self.log.debug("Source shape [pixel coords] {0:4.2f}x{1:4.2f}@{2:05.2f}".format(sx, sy, theta))
@@ -1101,6 +1363,7 @@ class SourceFinder(object):
 
             mx, my = np.where(np.isfinite(idata))
             non_nan_pix = len(mx)
+            stats[k]['pixels'] = non_nan_pix
             total_pix = len(allx.ravel())
             self.log.debug("island extracted:")
             self.log.debug(" x[{0}:{1}] y[{2}:{3}]".format(xmin, xmax, ymin, ymax))
@@ -1132,6 +1395,9 @@ class SourceFinder(object):
 
             # determine the number of free parameters and if we have enough data for a fit
             nfree = np.count_nonzero([params[p].vary for p in params.keys()])
+            stats[k]['t_parinfo'] = time.time() - starts[k]
+            stats[k]['components'] = params['components'].value
+            stats[k]['free'] = nfree
             self.log.debug(params)
             if nfree < 1:
                 self.log.debug(" Island has no components to fit")
@@ -1157,20 +1423,29 @@ class SourceFinder(object):
                     else:
                         self.log.critical("Cannot determine pixel beam")
                 fac = 1 / np.sqrt(2)
+                t0 = time.time()
                 if self.global_data.docov:
-                    C = Cmatrix(mx, my, pixbeam.a * FWHM2CC * fac, pixbeam.b * FWHM2CC * fac, pixbeam.pa)
-                    B = Bmatrix(C)
+                    C, B = correlation_matrices(mx, my, pixbeam.a * FWHM2CC * fac, pixbeam.b * FWHM2CC * fac,
+                                                pixbeam.pa)
                 else:
                     C = B = None
+                stats[k]['t_cmatrix'] = time.time() - t0
                 errs = np.nanmax(rmsimg[xmin:xmax, ymin:ymax])
+                t0 = time.time()
                 result, _ = do_lmfit(idata, params, B=B)
+                stats[k]['t_fit'] = time.time() - t0
+                stats[k]['nfev'] = result.nfev
+                t0 = time.time()
                 model = covar_errors(result.params, idata, errs=errs, B=B, C=C)
+                stats[k]['t_errors'] = time.time() - t0
 
             # convert the results to a source object
             offsets = (xmin, xmax, ymin, ymax)
             # TODO allow for island fluxes in the refitting.
             island_data = IslandFittingData(inum, i=idata, offsets=offsets, doislandflux=False, scalars=(4, 4, None))
+            t0 = time.time()
             new_src = self.result_to_components(result, model, island_data, src.flags)
+            stats[k]['t_wcs'] = time.time() - t0
 
             # preserve the uuid so we can do exact matching between catalogs
             for ns, s in zip(new_src, included_sources):
@@ -1186,16 +1461,21 @@ class SourceFinder(object):
                     ns.err_b = s.err_b
                     ns.err_pa = s.err_pa
             sources.extend(new_src)
-        return sources
+        starts[-1] = time.time()
+        stats['t_total'] = np.diff(starts)
+        return sources, stats
 
-    def _fit_island(self, island_data):
+    def _fit_island(self, island_data, stats=None):
         """
         Take an Island, do all the parameter estimation and fitting.
 
         :param island_data: an IslandFittingData object
+        :param stats: a record of type island_stats_dtype in which profiling information is stored
         :return: a list of sources that are within the island
         """
         global_data = self.global_data
+        if stats is None:
+            stats = np.zeros(1, dtype=island_stats_dtype)[0]
 
         # global data
         dcurve = global_data.dcurve
@@ -1224,8 +1504,15 @@ class SourceFinder(object):
         self.log.debug("=====")
         self.log.debug("Island ({0})".format(isle_num))
 
-        params = self.estimate_lmfit_parinfo(idata, rms, icurve, beam, innerclip, outerclip, offsets=[xmin, ymin],
-                                             max_summits=max_summits)
+        t0 = time.time()
+        params = None
+        if global_data.warmstart is not None:
+            params = self.warmstart_lmfit_parinfo(idata, rms, innerclip, outerclip, offsets=[xmin, ymin],
+                                                  max_summits=max_summits)
+        if params is None:
+            params = self.estimate_lmfit_parinfo(idata, rms, icurve, beam, innerclip, outerclip, offsets=[xmin, ymin],
+                                                 max_summits=max_summits)
+        stats['t_parinfo'] = time.time() - t0
 
         # islands at the edge of a region of nans
         # result in no components
@@ -1240,6 +1527,9 @@ class SourceFinder(object):
         mx, my = np.where(np.isfinite(idata))
         non_blank_pix = len(mx)
         free_vars = len([1 for a in params.keys() if params[a].vary])
+        stats['pixels'] = non_blank_pix
+        stats['components'] = params['components'].value
+        stats['free'] = free_vars
         if non_blank_pix < free_vars or free_vars == 0:
             self.log.debug("Island {0} doesn't have enough pixels to fit the given model".format(isle_num))
             self.log.debug("non_blank_pix {0}, free_vars {1}".format(non_blank_pix, free_vars))
@@ -1249,26 +1539,32 @@ class SourceFinder(object):
         else:
             # Model is the fitted parameters
             fac = 1 / np.sqrt(2)
+            t0 = time.time()
             if self.global_data.docov:
-                C = Cmatrix(mx, my, pixbeam.a * FWHM2CC * fac, pixbeam.b * FWHM2CC * fac, pixbeam.pa)
-                B = Bmatrix(C)
+                C, B = correlation_matrices(mx, my, pixbeam.a * FWHM2CC * fac, pixbeam.b * FWHM2CC * fac, pixbeam.pa)
             else:
                 C = B = None
+            stats['t_cmatrix'] = time.time() - t0
             self.log.debug(
                 "C({0},{1},{2},{3},{4})".format(len(mx), len(my), pixbeam.a * FWHM2CC, pixbeam.b * FWHM2CC, pixbeam.pa))
             errs = np.nanmax(rms)
             self.log.debug("Initial params")
             self.log.debug(params)
+            t0 = time.time()
             result, _ = do_lmfit(idata, params, B=B)
+            stats['t_fit'] = time.time() - t0
+            stats['nfev'] = result.nfev
             if not result.errorbars:
                 is_flag |= flags.FITERR
             # get the real (sky) parameter errors
+            t0 = time.time()
             model = covar_errors(result.params, idata, errs=errs, B=B, C=C)
             model.covar = result.covar
             if self.global_data.dobias and self.global_data.docov:
                 x, y = np.indices(idata.shape)
                 acf = elliptical_gaussian(x, y, 1, 0, 0, pixbeam.a * FWHM2CC * fac, pixbeam.b * FWHM2CC * fac, pixbeam.pa)
                 bias_correct(model, idata, acf=acf*errs**2)
+            stats['t_errors'] = time.time() - t0
 
             if not result.success:
                 is_flag |= flags.FITERR
@@ -1277,7 +1573,9 @@ class SourceFinder(object):
         self.log.debug(model)
 
         # convert the fitting results to a list of sources [and islands]
+        t0 = time.time()
         sources = self.result_to_components(result, model, island_data, is_flag)
+        stats['t_wcs'] = time.time() - t0
 
         return sources
 
@@ -1288,19 +1586,49 @@ class SourceFinder(object):
         a single process will fit multiple islands before returning results.
 
         :param islands: a list of IslandFittingData objects
-        :return: a list of OutputSources
+        :return: (sources, stats) a list of OutputSources and an array of island_stats_dtype
         """
         self.log.debug("Fitting group of {0} islands".format(len(islands)))
         sources = []
-        for island in islands:
-            res = self._fit_island(island)
+        stats = np.zeros(len(islands), dtype=island_stats_dtype)
+        for i, island in enumerate(islands):
+            t0 = time.time()
+            stats[i]['island'] = island.isle_num
+            res = self._fit_island(island, stats[i])
+            stats[i]['t_total'] = time.time() - t0
             sources.extend(res)
-        return sources
+        return sources, stats
+
+    def log_island_stats(self, nworst=5):
+        """
+        Write a summary of the per-island profiling statistics (self.island_stats) to the log.
+
+        :param nworst: the number of the slowest islands to report
+        :return: None
+        """
+        stats = self.island_stats
+        if len(stats) < 1:
+            self.log.info("No island statistics available")
+            return
+        self.log.info("Fit {0} islands in {1:.2f}s".format(len(stats), np.sum(stats['t_total'])))
+        self.log.info(" time (s) parinfo {0:.2f}, cmatrix {1:.2f}, fit {2:.2f}, errors {3:.2f}, wcs {4:.2f}".format(
+            *[np.sum(stats[t]) for t in ['t_parinfo', 't_cmatrix', 't_fit', 't_errors', 't_wcs']]))
+        fit = stats['nfev'] > 0
+        if np.any(fit):
+            self.log.info(" nfev total {0}, median {1:.0f}, max {2}".format(
+                np.sum(stats['nfev']), np.median(stats['nfev'][fit]), np.max(stats['nfev'])))
+        self.log.info(" slowest islands:")
+        self.log.info("  island pixels components free nfev t_total")
+        for row in np.sort(stats, order='t_total')[::-1][:nworst]:
+            self.log.info("  {0[island]:6d} {0[pixels]:6d} {0[components]:10d} {0[free]:4d} {0[nfev]:4d} "
+                          "{0[t_total]:7.3f}".format(row))
+        return
 
     def find_sources_in_image(self, filename, hdu_index=0, outfile=None, rms=None, max_summits=None, innerclip=5,
                               outerclip=4, cores=None, rmsin=None, bkgin=None, beam=None, doislandflux=False,
                               nopositive=False, nonegative=False, mask=None, lat=None, imgpsf=None, blank=False,
-                              docov=True, slice=None):
+                              docov=True, slice=None, warmstart=None, beamgrid=None, memmap=False, dtype=None,
+                              maskcache=None, psfinterp=False):
         """
         Run the Aegean source finder.
 
@@ -1329,6 +1657,19 @@ class SourceFinder(object):
         :param blank: Cause the output image to be blanked where islands are found.
         :param docov: True = include covariance matrix in the fitting process. (default=True)
         :param slice: For image cubes, slice determines which slice is used.
+        :param warmstart: A reference catalogue (file name or list of OutputSources) whose components are used
+                          as the initial parameters for the islands that they fall within.
+                          Islands are still found blind. (default=None)
+        :param beamgrid: If not None, the pixel beam is precomputed on a grid with this spacing (pixels)
+                         and interpolated, rather than calculated for every summit. (default=None)
+        :param memmap: If True the image is memory mapped rather than read into memory. Pixels that are modified
+                       (eg by background subtraction) are still copied into memory. (default=False)
+        :param dtype: The data type used for the image, eg np.float32 to halve the memory used by a float64 image.
+                      (default=None, use the type in the file)
+        :param maskcache: A directory in which to cache the rasterised mask, so that it can be reused for other
+                          images with the same WCS. (default=None, no caching)
+        :param psfinterp: If True the psf map is bilinearly interpolated rather than using the nearest pixel.
+                          (default=False)
         """
 
         # Tell numpy to be quiet
@@ -1337,7 +1678,10 @@ class SourceFinder(object):
             assert (cores >= 1), "cores must be one or more"
 
         self.load_globals(filename, hdu_index=hdu_index, bkgin=bkgin, rmsin=rmsin, beam=beam, rms=rms, cores=cores,
-                          verb=True, mask=mask, lat=lat, psf=imgpsf, blank=blank, docov=docov, slice=slice)
+                          verb=True, mask=mask, lat=lat, psf=imgpsf, blank=blank, docov=docov, slice=slice,
+                          beamgrid=beamgrid, memmap=memmap, dtype=dtype, maskcache=maskcache, psfinterp=psfinterp)
+        if warmstart is not None:
+            self._load_warmstart(warmstart)
         global_data = self.global_data
         rmsimg = global_data.rmsimg
         data = global_data.data_pix
@@ -1374,7 +1718,7 @@ class SourceFinder(object):
             # and submit to queue for subprocesses. Passing a group of islands is more
             # efficient than passing single islands to the subprocesses.
             if cores == 1:
-                res = self._fit_island(island_data)
+                res = self._fit_islands([island_data])
                 queue.append(res)
             else:
                 island_group.append(island_data)
@@ -1393,7 +1737,9 @@ class SourceFinder(object):
             print >> outfile, OutputSource.header
 
         sources = []
-        for srcs in queue:
+        island_stats = [self.island_stats]
+        for srcs, stats in queue:
+            island_stats.append(stats)
             if srcs:  # ignore empty lists
                 for src in srcs:
                     # ignore sources that we have been told to ignore
@@ -1403,11 +1749,12 @@ class SourceFinder(object):
                     if outfile:
                         print >> outfile, str(src)
         self.sources.extend(sources)
+        self.island_stats = np.concatenate(island_stats)
         return sources
 
     def priorized_fit_islands(self, filename, catalogue, hdu_index=0, outfile=None, bkgin=None, rmsin=None, cores=1,
                               rms=None, beam=None, lat=None, imgpsf=None, catpsf=None, stage=3, ratio=1.0, outerclip=3,
-                              doregroup=True, docov=True):
+                              doregroup=True, docov=True, psfinterp=False):
         """
         Take an input catalog, and image, and optional background/noise images
         fit the flux and ra/dec for each of the given sources, keeping the morphology fixed
@@ -1433,13 +1780,14 @@ class SourceFinder(object):
         :param ratio: ratio of image psf to catalog psf
         :param outerclip: pixels above an snr of this amount will be used in fitting, <0 -> all pixels.
         :param doregroup:  True - doregroup, False - use island data for groups
+        :param psfinterp: True - interpolate the psf maps, False - use the nearest pixel
         :return: a list of source objects
         """
 
         from AegeanTools.cluster import regroup
 
         self.load_globals(filename, hdu_index=hdu_index, bkgin=bkgin, rmsin=rmsin, rms=rms, cores=cores, verb=True,
-                          do_curve=False, beam=beam, lat=lat, psf=imgpsf, docov=docov)
+                          do_curve=False, beam=beam, lat=lat, psf=imgpsf, docov=docov, psfinterp=psfinterp)
 
         global_data = self.global_data
         far = 10 * global_data.beam.a  # degrees
@@ -1460,7 +1808,7 @@ class SourceFinder(object):
         # Expand each source size if needed.
         if catpsf is not None:
             self.log.info("Using catalog PSF from {0}".format(catpsf))
-            psf_helper = PSFHelper(catpsf, None)  # might need to set the WCSHelper to be not None
+            psf_helper = PSFHelper(catpsf, None, interpolate=psfinterp)  # might need to set the WCSHelper to be not None
             for i, src in enumerate(input_sources):
                 catbeam = psf_helper.get_beam(src.ra, src.dec)
                 imbeam = global_data.psfhelper.get_beam(src.ra, src.dec)
@@ -1536,8 +1884,11 @@ class SourceFinder(object):
                 queue.append(res)
 
         # now unpack the fitting results in to a list of sources
-        for s in queue:
+        island_stats = [self.island_stats]
+        for s, stats in queue:
             sources.extend(s)
+            island_stats.append(stats)
+        self.island_stats = np.concatenate(island_stats)
 
         sources = sorted(sources)
 
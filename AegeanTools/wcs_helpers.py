@@ -6,6 +6,7 @@ to make them a lot easier to use.
 """
 __author__ = 'Paul Hancock'
 
+import os
 import numpy as np
 
 from angle_tools import gcd, bear, translate
@@ -81,17 +82,49 @@ class WCSHelper(object):
         convert to pos=(ra,dec) coords
         """
         x, y = pixel
+        ra, dec = self.pix2sky_many([x], [y])
+        return np.array([ra[0], dec[0]])
+
+    def pix2sky_many(self, x, y):
+        """
+        Convert many pixel coordinates to sky coordinates with a single call to the WCS library.
+        x and y can be arrays of any (but the same) shape.
+        :param x: pixel coords
+        :param y: pixel coords
+        :return: ra, dec arrays with the same shape as x
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        if x.size == 0:
+            return x.copy(), y.copy()
         # wcs and pyfits have oposite ideas of x/y
-        return self.wcs.wcs_pix2world([[y, x]], 1)[0]
+        sky = self.wcs.wcs_pix2world(np.column_stack([y.ravel(), x.ravel()]), 1)
+        return sky[:, 0].reshape(x.shape), sky[:, 1].reshape(x.shape)
 
     def sky2pix(self, pos):
         """
         Take pos = (ra,dec) coords
         convert to pixel = (x,y) coords
         """
-        pixel = self.wcs.wcs_world2pix([pos], 1)
+        ra, dec = pos
+        x, y = self.sky2pix_many([ra], [dec])
+        return [x[0], y[0]]
+
+    def sky2pix_many(self, ra, dec):
+        """
+        Convert many sky coordinates to pixel coordinates with a single call to the WCS library.
+        ra and dec can be arrays of any (but the same) shape.
+        :param ra: sky coords
+        :param dec: sky coords
+        :return: x, y arrays with the same shape as ra
+        """
+        ra = np.asarray(ra, dtype=float)
+        dec = np.asarray(dec, dtype=float)
+        if ra.size == 0:
+            return ra.copy(), dec.copy()
+        pixel = self.wcs.wcs_world2pix(np.column_stack([ra.ravel(), dec.ravel()]), 1)
         # wcs and pyfits have oposite ideas of x/y
-        return [pixel[0][1], pixel[0][0]]
+        return pixel[:, 1].reshape(ra.shape), pixel[:, 0].reshape(ra.shape)
 
     def sky2pix_vec(self, pos, r, pa):
         """Convert a vector from sky to pixel corrds
@@ -107,13 +140,30 @@ class WCSHelper(object):
         r,theta - magnitude (pixels) and angle (degrees) of the original vector
         """
         ra, dec = pos
-        x, y = self.sky2pix(pos)
-        a = translate(ra, dec, r, pa)
-        locations = self.sky2pix(a)
-        x_off, y_off = locations
+        x, y, a, theta = self.sky2pix_vec_many([ra], [dec], [r], [pa])
+        return x[0], y[0], a[0], theta[0]
+
+    def sky2pix_vec_many(self, ra, dec, r, pa):
+        """
+        Array version of sky2pix_vec.
+        :param ra: arrays of vector origins
+        :param dec: arrays of vector origins
+        :param r: magnitudes in degrees
+        :param pa: angles in degrees
+        :return: x, y, r, theta (arrays)
+        """
+        ra, dec, r, pa = np.broadcast_arrays(*[np.asarray(v, dtype=float) for v in (ra, dec, r, pa)])
+        shape = ra.shape
+        ra, dec, r, pa = [v.ravel() for v in (ra, dec, r, pa)]
+        ra_off, dec_off = translate(ra, dec, r, pa)
+        # do all the conversions with one call
+        x, y = self.sky2pix_many(np.concatenate([ra, ra_off]), np.concatenate([dec, dec_off]))
+        n = ra.size
+        x, x_off = x[:n], x[n:]
+        y, y_off = y[:n], y[n:]
         a = np.sqrt((x - x_off) ** 2 + (y - y_off) ** 2)
         theta = np.degrees(np.arctan2((y_off - y), (x_off - x)))
-        return x, y, a, theta
+        return x.reshape(shape), y.reshape(shape), a.reshape(shape), theta.reshape(shape)
 
     def pix2sky_vec(self, pixel, r, theta):
         """
@@ -129,15 +179,31 @@ class WCSHelper(object):
         ra,dec - corresponding to pixels x,y
         r,pa - magnitude and angle (degrees) of the original vector, as measured on the sky
         """
-        ra1, dec1 = self.pix2sky(pixel)
         x, y = pixel
-        a = [x + r * np.cos(np.radians(theta)),
-             y + r * np.sin(np.radians(theta))]
-        locations = self.pix2sky(a)
-        ra2, dec2 = locations
+        ra, dec, a, pa = self.pix2sky_vec_many([x], [y], [r], [theta])
+        return ra[0], dec[0], a[0], pa[0]
+
+    def pix2sky_vec_many(self, x, y, r, theta):
+        """
+        Array version of pix2sky_vec.
+        :param x: arrays of vector origins
+        :param y: arrays of vector origins
+        :param r: magnitudes in pixels
+        :param theta: angles in degrees
+        :return: ra, dec, r, pa (arrays)
+        """
+        x, y, r, theta = np.broadcast_arrays(*[np.asarray(v, dtype=float) for v in (x, y, r, theta)])
+        shape = x.shape
+        x, y, r, theta = [v.ravel() for v in (x, y, r, theta)]
+        x_off = x + r * np.cos(np.radians(theta))
+        y_off = y + r * np.sin(np.radians(theta))
+        ra, dec = self.pix2sky_many(np.concatenate([x, x_off]), np.concatenate([y, y_off]))
+        n = x.size
+        ra1, ra2 = ra[:n], ra[n:]
+        dec1, dec2 = dec[:n], dec[n:]
         a = gcd(ra1, dec1, ra2, dec2)
         pa = bear(ra1, dec1, ra2, dec2)
-        return ra1, dec1, a, pa
+        return ra1.reshape(shape), dec1.reshape(shape), a.reshape(shape), pa.reshape(shape)
 
     def sky2pix_ellipse(self, pos, a, b, pa):
         """
@@ -156,15 +222,36 @@ class WCSHelper(object):
         :return: x, y, sx, sy, theta
         """
         ra, dec = pos
-        x, y = self.sky2pix(pos)
+        x, y, sx, sy, theta = self.sky2pix_ellipse_many([ra], [dec], [a], [b], [pa])
+        return x[0], y[0], sx[0], sy[0], theta[0]
 
-        x_off, y_off = self.sky2pix(translate(ra, dec, a, pa))
-        sx = np.hypot((x - x_off), (y - y_off))
-        theta = np.arctan2((y_off - y), (x_off - x))
+    def sky2pix_ellipse_many(self, ra, dec, a, b, pa):
+        """
+        Array version of sky2pix_ellipse.
+        All the required positions are converted with a single call to the WCS library.
 
-        x_off, y_off = self.sky2pix(translate(ra, dec, b, pa - 90))
-        sy = np.hypot((x - x_off), (y - y_off))
-        theta2 = np.arctan2((y_off - y), (x_off - x)) - np.pi / 2
+        :param ra: arrays of ellipse centers
+        :param dec: arrays of ellipse centers
+        :param a: major axes
+        :param b: minor axes
+        :param pa: position angles
+        :return: x, y, sx, sy, theta (arrays)
+        """
+        ra, dec, a, b, pa = np.broadcast_arrays(*[np.asarray(v, dtype=float) for v in (ra, dec, a, b, pa)])
+        shape = ra.shape
+        ra, dec, a, b, pa = [v.ravel() for v in (ra, dec, a, b, pa)]
+        ra_a, dec_a = translate(ra, dec, a, pa)
+        ra_b, dec_b = translate(ra, dec, b, pa - 90)
+        x, y = self.sky2pix_many(np.concatenate([ra, ra_a, ra_b]), np.concatenate([dec, dec_a, dec_b]))
+        n = ra.size
+        x, x_a, x_b = x[:n], x[n:2 * n], x[2 * n:]
+        y, y_a, y_b = y[:n], y[n:2 * n], y[2 * n:]
+
+        sx = np.hypot((x - x_a), (y - y_a))
+        theta = np.arctan2((y_a - y), (x_a - x))
+
+        sy = np.hypot((x - x_b), (y - y_b))
+        theta2 = np.arctan2((y_b - y), (x_b - x)) - np.pi / 2
 
         # The a/b vectors are perpendicular in sky space, but not always in pixel space
         # so we have to account for this by calculating the angle between the two vectors
@@ -172,7 +259,8 @@ class WCSHelper(object):
         defect = theta - theta2
         sy *= abs(np.cos(defect))
 
-        return x, y, sx, sy, np.degrees(theta)
+        theta = np.degrees(theta)
+        return x.reshape(shape), y.reshape(shape), sx.reshape(shape), sy.reshape(shape), theta.reshape(shape)
 
     def pix2sky_ellipse(self, pixel, sx, sy, theta):
         """
@@ -190,26 +278,46 @@ class WCSHelper(object):
         :param theta: position angle
         :return: ra, dec, a, b, pa
         """
-        ra, dec = self.pix2sky(pixel)
         x, y = pixel
-        v_sx = [x + sx * np.cos(np.radians(theta)),
-                y + sx * np.sin(np.radians(theta))]
-        ra2, dec2 = self.pix2sky(v_sx)
-        major = gcd(ra, dec, ra2, dec2)
-        pa = bear(ra, dec, ra2, dec2)
-
-        v_sy = [x + sy * np.cos(np.radians(theta - 90)),
-                y + sy * np.sin(np.radians(theta - 90))]
-        ra2, dec2 = self.pix2sky(v_sy)
-        minor = gcd(ra, dec, ra2, dec2)
-        pa2 = bear(ra, dec, ra2, dec2) - 90
+        ra, dec, major, minor, pa = self.pix2sky_ellipse_many([x], [y], [sx], [sy], [theta])
+        return ra[0], dec[0], major[0], minor[0], pa[0]
+
+    def pix2sky_ellipse_many(self, x, y, sx, sy, theta):
+        """
+        Array version of pix2sky_ellipse.
+        All the required positions are converted with a single call to the WCS library.
+
+        :param x: arrays of ellipse centers
+        :param y: arrays of ellipse centers
+        :param sx: major axes
+        :param sy: minor axes
+        :param theta: position angles
+        :return: ra, dec, a, b, pa (arrays)
+        """
+        x, y, sx, sy, theta = np.broadcast_arrays(*[np.asarray(v, dtype=float) for v in (x, y, sx, sy, theta)])
+        shape = x.shape
+        x, y, sx, sy, theta = [v.ravel() for v in (x, y, sx, sy, theta)]
+        x_a = x + sx * np.cos(np.radians(theta))
+        y_a = y + sx * np.sin(np.radians(theta))
+        x_b = x + sy * np.cos(np.radians(theta - 90))
+        y_b = y + sy * np.sin(np.radians(theta - 90))
+        ra, dec = self.pix2sky_many(np.concatenate([x, x_a, x_b]), np.concatenate([y, y_a, y_b]))
+        n = x.size
+        ra, ra_a, ra_b = ra[:n], ra[n:2 * n], ra[2 * n:]
+        dec, dec_a, dec_b = dec[:n], dec[n:2 * n], dec[2 * n:]
+
+        major = gcd(ra, dec, ra_a, dec_a)
+        pa = bear(ra, dec, ra_a, dec_a)
+
+        minor = gcd(ra, dec, ra_b, dec_b)
+        pa2 = bear(ra, dec, ra_b, dec_b) - 90
 
         # The a/b vectors are perpendicular in sky space, but not always in pixel space
         # so we have to account for this by calculating the angle between the two vectors
         # and modifying the minor axis length
         defect = pa - pa2
         minor *= abs(np.cos(np.radians(defect)))
-        return ra, dec, major, minor, pa
+        return ra.reshape(shape), dec.reshape(shape), major.reshape(shape), minor.reshape(shape), pa.reshape(shape)
 
     def get_pixbeam_pixel(self, x, y):
         """
@@ -246,23 +354,35 @@ class WCSHelper(object):
 
         if ra is None:
             ra, dec = self.pix2sky(self.refpix)
-        pos = [ra, dec]
+        major, minor, theta = self.get_pixbeam_many([ra], [dec])
+        if not np.isfinite(major[0]):
+            return None
+        return Beam(major[0], minor[0], theta[0])
 
-        beam = self.get_beam(ra, dec)
-        _, _, major, minor, theta = self.sky2pix_ellipse(pos, beam.a, beam.b, beam.pa)
-
-        if major < minor:
-            major, minor = minor, major
-            theta -= 90
-            if theta < -180:
-                theta += 180
-        if not np.isfinite(theta):
-            theta = 0
-        if not all(np.isfinite([major, minor, theta])):
-            beam = None
+    def get_pixbeam_many(self, ra, dec):
+        """
+        Array version of get_pixbeam.
+        :param ra: Sky coords
+        :param dec: Sky coords
+        :return: a, b, pa arrays of the beam in pixel scale. Locations with an invalid beam are nan.
+        """
+        ra, dec = np.broadcast_arrays(np.asarray(ra, dtype=float), np.asarray(dec, dtype=float))
+        # scale the major axis based on the declination, as per get_beam
+        if self.lat is None:
+            factor = np.ones(ra.shape)
         else:
-            beam = Beam(major, minor, theta)
-        return beam
+            factor = np.cos(np.radians(dec - self.lat))
+        _, _, major, minor, theta = self.sky2pix_ellipse_many(ra, dec, self.beam.a / factor, self.beam.b,
+                                                              self.beam.pa)
+
+        swap = major < minor
+        major[swap], minor[swap] = minor[swap], major[swap]
+        theta[swap] -= 90
+        theta[swap & (theta < -180)] += 180
+        theta[~np.isfinite(theta)] = 0
+        bad = ~(np.isfinite(major) & np.isfinite(minor))
+        major[bad] = minor[bad] = theta[bad] = np.nan
+        return major, minor, theta
 
     def get_beamarea_deg2(self, ra, dec):
         """
@@ -426,28 +546,107 @@ class PSFHelper(WCSHelper):
     - the ability to load psf/beam information from a fits file
     """
 
+    # psf maps that have been loaded, so that instances using the same file can share them
+    # {abspath: (mtime, hdulist, data, wcs)}, only the most recent version of each file is kept
+    _psf_maps = {}
+
     # This __init__ overwrites that of the parent class without calling 'super'.
     # It might be naughty but it beats rewriting many of the get_X functions that I want to replicate.
-    def __init__(self, psffile, wcshelper):
+    def __init__(self, psffile, wcshelper, interpolate=False):
+        """
+        :param psffile: filename of the psf map, or None to use the beam from the wcshelper
+        :param wcshelper: the WCSHelper of the image
+        :param interpolate: If True, the psf map is bilinearly interpolated rather than using the nearest pixel
+        """
         if psffile is None:  # in this case this class should be transparent
             data = None
             wcs = wcshelper.wcs
         else:
+            data, wcs = self._load_psf_map(psffile)
+        self.interpolate = interpolate
+        self.wcshelper = wcshelper
+        self.data = data
+        self.wcs = wcs
+        # see make_pixbeam_grid
+        self.pixbeam_grid = None
+        self.pixbeam_step = None
+
+    @classmethod
+    def _load_psf_map(cls, psffile):
+        """
+        Memory map the data and parse the wcs of a psf file.
+        Files that have already been loaded (and not changed since) are not loaded again.
+        If a file has changed then the old version is closed and replaced.
+        :param psffile: filename
+        :return: data, wcs
+        """
+        path = os.path.abspath(psffile)
+        mtime = os.path.getmtime(psffile)
+        if path in cls._psf_maps and cls._psf_maps[path][0] != mtime:
+            log.debug("PSF file {0} has changed, closing the old version".format(psffile))
+            # instances still holding the old data keep the map alive until they are done with it
+            cls._psf_maps.pop(path)[1].close()
+        if path not in cls._psf_maps:
             log.info("Loading PSF data from {0}".format(psffile))
-            header = fits.getheader(psffile)
-            data = fits.getdata(psffile)
+            hdulist = fits.open(psffile, memmap=True)
+            hdu = hdulist[0]
+            header = hdu.header
+            data = hdu.data
             # the psf image has to have three dimensions
             # and they need to be ra/dec/beam
             if len(data.shape) != 3:
                 log.critical("PSF file needs to have 3 dimensions, only {0} found".format(len(data.shape)))
+                hdulist.close()
                 raise Exception("Invalid PSF file {0}".format(psffile))
             try:
                 wcs = pywcs.WCS(header, naxis=2)
             except:
                 wcs = pywcs.WCS(str(header), naxis=2)
-        self.wcshelper = wcshelper
-        self.data = data
-        self.wcs = wcs
+            cls._psf_maps[path] = (mtime, hdulist, data, wcs)
+        return cls._psf_maps[path][2:]
+
+    def make_pixbeam_grid(self, shape, step=16):
+        """
+        Precompute the pixel beam on a grid of pixels that covers an image,
+        so that get_pixbeam_pixel can interpolate instead of doing the wcs conversions.
+        :param shape: the shape of the image
+        :param step: the spacing of the grid in pixels
+        :return: None
+        """
+        nx, ny = [int(np.ceil((n - 1.) / step)) + 1 for n in shape]
+        gx, gy = np.meshgrid(step * np.arange(nx), step * np.arange(ny), indexing='ij')
+        ra, dec = self.wcshelper.pix2sky_many(gx, gy)
+        self.pixbeam_grid = np.array(self.get_pixbeam_many(ra, dec))
+        self.pixbeam_step = step
+        log.debug("Pixel beam computed on a {0}x{1} grid".format(nx, ny))
+        return
+
+    def _interp_pixbeam(self, x, y):
+        """
+        Bilinear interpolation of the pixbeam grid.
+        :return: Beam(a,b,pa), or None if x,y are not within the grid or near an invalid beam
+        """
+        fx = x / float(self.pixbeam_step)
+        fy = y / float(self.pixbeam_step)
+        nx, ny = self.pixbeam_grid.shape[1:]
+        if not (0 <= fx <= nx - 1 and 0 <= fy <= ny - 1) or nx < 2 or ny < 2:
+            return None
+        i = min(int(fx), nx - 2)
+        j = min(int(fy), ny - 2)
+        # work with python floats as this is called for every summit
+        a00, a01, a10, a11, b00, b01, b10, b11, p00, p01, p10, p11 = \
+            self.pixbeam_grid[:, i:i + 2, j:j + 2].ravel().tolist()
+        if not np.isfinite(a00 + a01 + a10 + a11 + b00 + b01 + b10 + b11 + p00 + p01 + p10 + p11):
+            return None
+        u = fx - i
+        v = fy - j
+        w00, w01, w10, w11 = (1 - u) * (1 - v), (1 - u) * v, u * (1 - v), u * v
+        a = w00 * a00 + w01 * a01 + w10 * a10 + w11 * a11
+        b = w00 * b00 + w01 * b01 + w10 * b10 + w11 * b11
+        # interpolate the position angle relative to the first corner, pa is only defined modulo 180
+        pa = p00 + (w01 * ((p01 - p00 + 90) % 180 - 90) + w10 * ((p10 - p00 + 90) % 180 - 90) +
+                    w11 * ((p11 - p00 + 90) % 180 - 90))
+        return Beam(a, b, pa)
 
     def get_psf_sky(self, ra, dec):
         """
@@ -464,13 +663,54 @@ class PSFHelper(WCSHelper):
             beam = self.wcshelper.get_beam(ra, dec)
             return beam.a, beam.b, beam.pa
 
-        x, y = self.sky2pix([ra, dec])
-        # We leave the interpolation in the hands of whoever is making these images
+        a, b, pa = self.get_psf_sky_many([ra], [dec])
+        return np.array([a[0], b[0], pa[0]])
+
+    def get_psf_sky_many(self, ra, dec):
+        """
+        Array version of get_psf_sky.
+        :param ra:
+        :param dec:
+        :return: a, b, pa arrays in degrees. Locations that are not within the psf map are nan.
+        """
+        ra, dec = np.broadcast_arrays(np.asarray(ra, dtype=float), np.asarray(dec, dtype=float))
+        if self.data is None:
+            beam = self.wcshelper.beam
+            if self.wcshelper.lat is None:
+                factor = np.ones(ra.shape)
+            else:
+                factor = np.cos(np.radians(dec - self.wcshelper.lat))
+            return beam.a / factor, np.ones(ra.shape) * beam.b, np.ones(ra.shape) * beam.pa
+
+        x, y = self.sky2pix_many(ra, dec)
+        bad = ~(np.isfinite(x) & np.isfinite(y))
+        x[bad] = y[bad] = 1
+        nx, ny = self.data.shape[1:]
+        # sky2pix gives 1-based pixel coords, the psf map is 0-based
         # clamping the x,y coords at the image boundaries just makes sense
-        x = int(np.clip(x, 0, self.data.shape[1] - 1))
-        y = int(np.clip(y, 0, self.data.shape[2] - 1))
-        psf_sky = self.data[:, x, y]
-        return psf_sky
+        x = np.clip(x - 1, 0, nx - 1)
+        y = np.clip(y - 1, 0, ny - 1)
+        if not self.interpolate:
+            # use the nearest pixel
+            psf_sky = self.data[:, np.round(x).astype(int), np.round(y).astype(int)].astype(float)
+        else:
+            i = np.minimum(x.astype(int), max(nx - 2, 0))
+            j = np.minimum(y.astype(int), max(ny - 2, 0))
+            u = x - i
+            v = y - j
+            i1 = np.minimum(i + 1, nx - 1)
+            j1 = np.minimum(j + 1, ny - 1)
+            corners = [(self.data[:, i, j], (1 - u) * (1 - v)), (self.data[:, i, j1], (1 - u) * v),
+                       (self.data[:, i1, j], u * (1 - v)), (self.data[:, i1, j1], u * v)]
+            psf_sky = np.zeros((3,) + x.shape)
+            pa0 = corners[0][0][2].astype(float)
+            for c, w in corners:
+                psf_sky[:2] += c[:2] * w
+                # pa is only defined modulo 180 so interpolate relative to the first corner
+                psf_sky[2] += ((c[2] - pa0 + 90) % 180 - 90) * w
+            psf_sky[2] += pa0
+        psf_sky[:, bad] = np.nan
+        return psf_sky[0], psf_sky[1], psf_sky[2]
 
     def get_psf_pix(self, ra, dec):
         """
@@ -494,6 +734,10 @@ class PSFHelper(WCSHelper):
         :param y: pixel coord
         :return: Beam(a,b,pa)
         """
+        if self.pixbeam_grid is not None:
+            beam = self._interp_pixbeam(x, y)
+            if beam is not None:
+                return beam
         # overriding the WCSHelper function of the same name means that we now calculate the
         # psf at the coordinates of the x/y pixel in the image WCS, rather than the psfimage WCS
         ra, dec = self.wcshelper.pix2sky([x, y])
@@ -516,6 +760,21 @@ class PSFHelper(WCSHelper):
             return None
         return Beam(psf[0], psf[1], psf[2])
 
+    def get_pixbeam_many(self, ra, dec):
+        """
+        Array version of get_pixbeam.
+        :param ra: Sky coords
+        :param dec: Sky coords
+        :return: a, b, pa arrays of the beam in pixel scale. Locations with an invalid beam are nan.
+        """
+        if self.data is None:
+            return self.wcshelper.get_pixbeam_many(ra, dec)
+        a, b, pa = self.get_psf_sky_many(ra, dec)
+        _, _, a, b, pa = self.wcshelper.sky2pix_ellipse_many(ra, dec, a, b, pa)
+        bad = ~(np.isfinite(a) & np.isfinite(b) & np.isfinite(pa))
+        a[bad] = b[bad] = pa[bad] = np.nan
+        return a, b, pa
+
     def get_beam(self, ra, dec):
         """
         """
@@ -548,18 +807,68 @@ class PSFHelper(WCSHelper):
 
 class PSFHelperTest(object):
     """
-
+    A test class for PSFHelper
     """
 
-    def __init__(self):
-        psffile = "Test/Images/1904_66_SIN_psf.fits"
-        wcsfile = "Test/Images/1904_66_SIN.fits"
-        psfdata = fits.getdata(psffile)
-        self.helper = PSFHelper(psfdata, WCSHelper.from_file(wcsfile))
+    def __init__(self, fname):
+        import tempfile
+        self.wcshelper = WCSHelper.from_file(fname)
+        self.psffile = os.path.join(tempfile.mkdtemp(), 'psf.fits')
+        self.test_pixel_convention()
+        self.test_psf_map_cache()
+
+    def write_psf_map(self, offset=0):
+        """
+        Write a psf map on the image wcs, where the a/b value of each pixel encodes its position.
+        """
+        data = np.zeros((3, 20, 30), dtype=np.float32)
+        row, col = np.indices(data.shape[1:])
+        data[0] = data[1] = offset + 100 * row + col
+        header = self.wcshelper.wcs.celestial.to_header()
+        fits.writeto(self.psffile, data, header=header, overwrite=True)
+
+    def test_pixel_convention(self):
+        """
+        The nearest pixel and interpolated lookups should agree at the centre of every psf pixel.
+        """
+        print "Testing psf map pixel convention... ",
+        self.write_psf_map()
+        nearest = PSFHelper(self.psffile, self.wcshelper)
+        interp = PSFHelper(self.psffile, self.wcshelper, interpolate=True)
+        row, col = [i.ravel() for i in np.indices((20, 30))]
+        ra, dec = nearest.wcs.wcs_pix2world(np.column_stack([col, row]), 0).T
+        expected = 100 * row + col
+        a_near = nearest.get_psf_sky_many(ra, dec)[0]
+        a_interp = interp.get_psf_sky_many(ra, dec)[0]
+        if np.all(a_near == expected) and np.allclose(a_interp, expected):
+            print "Pass"
+            return True
+        print "Fail"
+        return False
+
+    def test_psf_map_cache(self):
+        """
+        Rewriting a psf map should replace the cached version rather than add to the cache.
+        """
+        print "Testing psf map cache... ",
+        self.write_psf_map()
+        PSFHelper(self.psffile, self.wcshelper)
+        nmaps = len(PSFHelper._psf_maps)
+        self.write_psf_map(offset=1e4)
+        # make sure the modification time changes
+        mtime = os.path.getmtime(self.psffile) + 10
+        os.utime(self.psffile, (mtime, mtime))
+        helper = PSFHelper(self.psffile, self.wcshelper)
+        if len(PSFHelper._psf_maps) == nmaps and helper.data[0, 0, 0] == 1e4:
+            print "Pass"
+            return True
+        print "Fail"
+        return False
 
 
 if __name__ == "__main__":
     import sys
 
     test_img = sys.argv[-1]
+    PSFHelperTest(test_img)
     WCSHelperTest(test_img)
\ No newline at end of file
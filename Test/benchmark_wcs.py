@@ -0,0 +1,85 @@
+#! /usr/bin/env python
+"""
+Micro-benchmark for the scalar vs array versions of the WCSHelper ellipse conversions,
+and for the cost of the exact WCS conversions per point and per call.
+
+usage: python Test/benchmark_wcs.py [image.fits] [n]
+"""
+
+import sys
+import time
+import numpy as np
+from AegeanTools.wcs_helpers import WCSHelper
+
+__author__ = 'Paul Hancock'
+
+
+def benchmark(filename, n=10**5, nscalar=10**4):
+    """
+    Convert n random ellipses from sky->pix->sky coordinates using the array methods,
+    and nscalar of them using the scalar methods. The scalar timing is scaled up to n ellipses.
+    """
+    helper = WCSHelper.from_file(filename)
+    ra0, dec0 = helper.pix2sky(helper.refpix)
+    np.random.seed(1234)
+    ra = ra0 + np.random.uniform(-5, 5, n)
+    dec = dec0 + np.random.uniform(-5, 5, n)
+    a = helper.beam.a * np.random.uniform(1, 3, n)
+    b = helper.beam.b * np.random.uniform(0.5, 1, n)
+    pa = np.random.uniform(-90, 90, n)
+
+    t0 = time.time()
+    x, y, sx, sy, theta = helper.sky2pix_ellipse_many(ra, dec, a, b, pa)
+    t1 = time.time()
+    helper.pix2sky_ellipse_many(x, y, sx, sy, theta)
+    t2 = time.time()
+    print "array  sky2pix_ellipse_many {0:8.3f}s  pix2sky_ellipse_many {1:8.3f}s  ({2} ellipses)".format(
+        t1 - t0, t2 - t1, n)
+
+    t0 = time.time()
+    for i in xrange(nscalar):
+        helper.sky2pix_ellipse([ra[i], dec[i]], a[i], b[i], pa[i])
+    t1 = time.time()
+    for i in xrange(nscalar):
+        helper.pix2sky_ellipse([x[i], y[i]], sx[i], sy[i], theta[i])
+    t2 = time.time()
+    scale = float(n) / nscalar
+    print "scalar sky2pix_ellipse      {0:8.3f}s  pix2sky_ellipse      {1:8.3f}s  (scaled from {2} ellipses)".format(
+        (t1 - t0) * scale, (t2 - t1) * scale, nscalar)
+
+
+def benchmark_exact(filename, n=10**5, ncalls=10**4):
+    """
+    Time the exact pix2sky/sky2pix conversions for n points in a single call,
+    and the overhead of ncalls calls of one point each.
+    """
+    helper = WCSHelper.from_file(filename)
+    np.random.seed(1234)
+    x = helper.refpix[0] + np.random.uniform(-200, 200, n)
+    y = helper.refpix[1] + np.random.uniform(-200, 200, n)
+
+    t0 = time.time()
+    ra, dec = helper.pix2sky_many(x, y)
+    t1 = time.time()
+    helper.sky2pix_many(ra, dec)
+    t2 = time.time()
+    print "exact  pix2sky_many {0:8.3f}s  sky2pix_many {1:8.3f}s  ({2} points, {3:.2f} us/point)".format(
+        t1 - t0, t2 - t1, n, 1e6 * (t2 - t0) / (2 * n))
+
+    t0 = time.time()
+    for i in xrange(ncalls):
+        helper.pix2sky([x[i], y[i]])
+    t1 = time.time()
+    print "exact  pix2sky      {0:8.3f}s  ({1} calls, {2:.2f} us/call)".format(
+        t1 - t0, ncalls, 1e6 * (t1 - t0) / ncalls)
+
+
+if __name__ == "__main__":
+    fname = 'Test/Images/1904-66_SIN.fits'
+    n = 10**5
+    if len(sys.argv) > 1:
+        fname = sys.argv[1]
+    if len(sys.argv) > 2:
+        n = int(sys.argv[2])
+    benchmark(fname, n, min(n, 10**4))
+    benchmark_exact(fname, n, min(n, 10**4))